@@ -8,17 +8,12 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 import logging
-# for debugging, sending errors to email or logging to file
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
 
 
-app = Flask(__name__)
-app.config.from_object(Config)
 # database
 db = SQLAlchemy()
 # migration engine
@@ -42,6 +37,13 @@ babel = Babel()
 
 
 def create_app(config_class=Config):
+	app = Flask(__name__)
+	app.config.from_object(config_class)
+
+	# before the extensions below, which set up app.jinja_env
+	from app.template_cache import template_cache
+	template_cache.init_app(app)
+
 	db.init_app(app)
 	migrate.init_app(app, db)
 	login.init_app(app)
@@ -50,6 +52,24 @@ def create_app(config_class=Config):
 	moment.init_app(app)
 	babel.init_app(app)
 
+	from app.last_seen import last_seen_buffer
+	last_seen_buffer.init_app(app)
+	from app.user_cache import user_cache
+	user_cache.init_app(app)
+	from app.follow_graph import follow_graph
+	follow_graph.init_app(app)
+	from app.language import language_detector, language_worker
+	language_detector.init_app(app)
+	language_worker.init_app(app)
+	from app.translation_cache import translation_cache
+	translation_cache.init_app(app)
+	from app.email import mail_dispatcher
+	mail_dispatcher.init_app(app)
+	from app.translate import translator_client, breaker, single_flight
+	translator_client.init_app(app)
+	breaker.init_app(app)
+	single_flight.init_app(app)
+
 	from app.errors import bp as errors_bp
 	app.register_blueprint(errors_bp)
 	from app.auth import bp as auth_bp
@@ -59,31 +79,17 @@ def create_app(config_class=Config):
 
 
 	# if the server is not running in debug mode, we need another way of receiving errors: emails
-	if not app.debug:
+	if not app.debug and not app.testing:
 		# if there is a dictionary containing configuration options for the mail_server. We added it in the config
 		if app.config['MAIL_SERVER']:
-			auth = None
-			if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-				auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-			secure = None
-			if app.config['MAIL_USE_TLS']:
-				secure = ()
-			mail_handler = SMTPHandler(
-				mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-				fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-				toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-				credentials=auth, secure=secure)
-			mail_handler.setLevel(logging.ERROR)
-			app.logger.addHandler(mail_handler)
+			# errors are queued, grouped and mailed as one summary per group from a thread of its own, see app/error_mail.py
+			from app.error_mail import error_mail_handler
+			app.logger.addHandler(error_mail_handler(app))
 
 		# we want to have a log file for the server, as we may want to see failure conditions that do not lead to Python exceptions
-		if not os.path.exists('logs'): # if there is no logs directory, create one
-			os.mkdir('logs')
-		# rotating logs ensure that the file does not exceed a certain length (in this case 10kb,) and allows backups
-		file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240, backupCount=10)
-		file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-		file_handler.setLevel(logging.INFO)
-		app.logger.addHandler(file_handler)
+		# it is written by a thread of its own, rotated by size or time and optionally gzipped, see app/logs.py
+		from app.logs import file_log_handler
+		app.logger.addHandler(file_log_handler(app))
 
 		# the levels of logging are: DEBUG, INFO, WARNING, ERROR and CRITICAL.
 		app.logger.setLevel(logging.INFO)
@@ -3,6 +3,7 @@ from app.auth import bp
 from app.models import User, Post
 from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordEmailForm, ResetPasswordForm
 from app.auth.email import send_password_reset_email
+from app.user_cache import user_cache
 
 from flask import render_template, flash, redirect, url_for, request
 from flask_login import current_user, login_user, login_required, logout_user
@@ -87,6 +88,7 @@ def reset_password(token):
 	if form.validate_on_submit():
 		user.set_password(form.password.data)
 		db.session.commit()
+		user_cache.invalidate(user.id)
 		flash('Your password has been reset.')
 		return redirect(url_for('auth.login'))
 	return render_template('auth/reset_password.html', form=form)
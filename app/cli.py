@@ -1,5 +1,10 @@
 import os
 import click
+from app import db
+from app.models import User, Post, Timeline
+from app.language import backfill_languages
+from app.email import mail_dispatcher
+from app.template_cache import template_cache
 
 def register(app):
 	@app.cli.group()
@@ -32,3 +37,76 @@ def register(app):
 		"""Compile all languages."""
 		if os.system('pybabel compile -d app/translations'):
 			raise RuntimeError('compile command failed')
+
+	@app.cli.group()
+	def timeline():
+		"""Home timeline maintenance commands."""
+		pass
+
+	@timeline.command()
+	def rebuild():
+		"""Rebuild every home timeline from the posts and followers tables."""
+		Timeline.rebuild()
+		db.session.commit()
+		click.echo('Rebuilt {} timeline entries.'.format(Timeline.query.count()))
+
+	@app.cli.group()
+	def counters():
+		"""Follower, following and post counter commands."""
+		pass
+
+	@counters.command()
+	def reconcile():
+		"""Recompute every user's counters and repair the ones that drifted."""
+		repaired = User.reconcile_counters()
+		db.session.commit()
+		click.echo('Repaired the counters of {} users.'.format(repaired))
+
+	@app.cli.group()
+	def posts():
+		"""Post maintenance commands."""
+		pass
+
+	@posts.command('detect-languages')
+	@click.option('--chunk-size', default=1000, help='Posts read, detected and written per batch.')
+	@click.option('--workers', default=0, help='Detection processes, defaults to one per CPU.')
+	@click.option('--after-id', default=0, help='Resume after this post id.')
+	def detect_languages(chunk_size, workers, after_id):
+		"""Detect the language of every post that does not have one yet."""
+		total = Post.query.filter(Post.language == None, Post.id > after_id).count()
+		def progress(done, last_id):
+			click.echo('{}/{} posts, last id {}'.format(done, total, last_id))
+		done = backfill_languages(chunk_size, workers, after_id, progress)
+		click.echo('Detected the language of {} posts.'.format(done))
+
+	@app.cli.group()
+	def mail():
+		"""Outgoing mail commands."""
+		pass
+
+	@mail.command()
+	@click.option('--deferred', is_flag=True, help='Also send the messages waiting for a retry.')
+	def drain(deferred):
+		"""Send all queued mail now."""
+		sent, retried, dead = mail_dispatcher.drain(deferred)
+		click.echo('Sent {} messages, {} failed and will be retried, {} gave up.'.format(sent, retried, dead))
+
+	@app.cli.group()
+	def templates():
+		"""Template commands."""
+		pass
+
+	@templates.command()
+	@click.option('--clear', is_flag=True, help='Remove everything in the cache first.')
+	def precompile(clear):
+		"""Compile every template into the template cache."""
+		if template_cache.bytecode_cache is None:
+			raise click.ClickException('TEMPLATE_CACHE_DIR is not set.')
+		if clear:
+			template_cache.clear()
+		compiled, failed = template_cache.precompile(app)
+		for name, error in failed:
+			click.echo('{}: {}'.format(name, error), err=True)
+		click.echo('Compiled {} templates into {}.'.format(len(compiled), app.config['TEMPLATE_CACHE_DIR']))
+		if failed:
+			raise click.ClickException('{} templates did not compile.'.format(len(failed)))
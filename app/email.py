@@ -1,16 +1,222 @@
+import json
+import smtplib
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
 from flask_mail import Message
-from app import mail
-from threading import Thread
-from flask import current_app
+from app import db, mail
+from app.models import OutgoingMail
+
+# one SMTP session held open by a mail worker across messages, so a burst costs one connect, TLS handshake and login
+# per MAIL_MAX_EMAILS messages (Flask-Mail reconnects after that many) instead of one per message
+class SMTPSession(object):
+	def __init__(self):
+		self.connection = None
+
+	def send(self, msg):
+		if self.connection is None:
+			connection = mail.connect()
+			connection.__enter__()
+			self.connection = connection
+		self.connection.send(msg)
+
+	def close(self):
+		if self.connection is not None:
+			connection, self.connection = self.connection, None
+			try:
+				connection.__exit__(None, None, None)
+			except (smtplib.SMTPException, OSError):
+				pass # the server has hung up already
+
+
+# outgoing mail is written to the mail_outbox table and sent by a fixed number of worker threads, so a burst of mail
+# costs rows instead of threads, and mail queued when the process stops is sent once it is back.
+# a worker claims a batch of due messages by stamping them with its token and a claim deadline, so any number of
+# workers and processes can share the table; the messages of a worker that died are due again once their claim runs
+# out, which makes delivery at-least-once. a failed message is retried after MAIL_RETRY_BACKOFF seconds, doubled for
+# every attempt, and after MAIL_MAX_ATTEMPTS attempts it is marked dead and left in the table for someone to look at.
+# with MAIL_REUSE_CONNECTIONS each worker sends its batches over an SMTPSession that it keeps until it runs out of mail
+class MailDispatcher(object):
+	CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, socket.timeout,
+		socket.gaierror)
+
+	def __init__(self, app=None):
+		self.app = None
+		self.threads = []
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.stopping = threading.Event()
+		self.reset_stats()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.stop()
+		self.app = app
+		self.workers = app.config['MAIL_WORKERS']
+		self.batch_size = app.config['MAIL_BATCH_SIZE']
+		self.max_attempts = app.config['MAIL_MAX_ATTEMPTS']
+		self.backoff = app.config['MAIL_RETRY_BACKOFF']
+		self.poll_interval = app.config['MAIL_POLL_INTERVAL']
+		self.claim_timeout = timedelta(seconds=app.config['MAIL_CLAIM_TIMEOUT'])
+		self.reuse_connections = app.config['MAIL_REUSE_CONNECTIONS']
+		self.reset_stats()
+		if self.workers > 0:
+			app.before_first_request(self.start) # picks up whatever was queued before a restart
+
+	def reset_stats(self):
+		self.sent = 0
+		self.retried = 0
+		self.dead = 0
+
+	def start(self):
+		with self.lock:
+			if self.threads or self.workers <= 0:
+				return
+			self.stopping = threading.Event()
+			self.threads = [threading.Thread(target=self.run, name='mail-{}'.format(i), daemon=True)
+				for i in range(self.workers)]
+			for thread in self.threads:
+				thread.start()
+
+	def stop(self):
+		with self.lock:
+			threads, self.threads = self.threads, []
+			self.stopping.set()
+			self.wakeup.set()
+		for thread in threads:
+			thread.join()
+		self.wakeup.clear()
+
+	def enqueue(self, subject, sender, recipients, text_body, html_body):
+		# on a connection of its own, so the message is queued even if the request's session is rolled back
+		with db.engine.begin() as connection:
+			connection.execute(OutgoingMail.__table__.insert().values(subject=subject, sender=sender,
+				recipients=json.dumps(recipients), text_body=text_body, html_body=html_body, status='pending',
+				attempts=0, next_attempt_at=datetime.utcnow(), created_at=datetime.utcnow()))
+		if self.workers > 0:
+			self.start()
+			self.wakeup.set()
+
+	def run(self):
+		session = SMTPSession()
+		while not self.stopping.is_set():
+			with self.app.app_context():
+				try:
+					processed = self.process_batch(session)
+				except Exception:
+					self.app.logger.exception('Mail worker failed')
+					session.close()
+					processed = 0
+				finally:
+					db.session.remove()
+			if not processed:
+				session.close() # no point holding a connection the server will time out
+				self.wakeup.wait(self.poll_interval)
+				self.wakeup.clear()
+		session.close()
+
+	# claims up to limit due messages for this worker and returns them
+	def claim(self, limit):
+		now = datetime.utcnow()
+		token = uuid.uuid4().hex
+		table = OutgoingMail.__table__
+		due = table.c.status.in_(['pending', 'sending']) & (table.c.next_attempt_at <= now)
+		ids = db.select(table.c.id).where(due).order_by(table.c.next_attempt_at, table.c.id).limit(limit)
+		with db.engine.begin() as connection:
+			connection.execute(table.update().where(table.c.id.in_(ids.scalar_subquery()) & due).values(
+				status='sending', claim=token, next_attempt_at=now + self.claim_timeout))
+		return OutgoingMail.query.filter_by(claim=token).order_by(OutgoingMail.id).all()
+
+	# sends one claimed batch and records the outcome of every message with a single commit; returns the batch size.
+	# when the server cannot be reached the rest of the batch is put back without trying, and without spending one of
+	# its attempts, since the server never saw it
+	def process_batch(self, session):
+		messages = self.claim(self.batch_size)
+		unreachable = None
+		for message in messages:
+			if unreachable is not None:
+				self.release(message, unreachable)
+				continue
+			try:
+				self.deliver(message, session)
+			except self.CONNECTION_ERRORS as e:
+				session.close()
+				self.failed(message, e)
+				unreachable = e
+			except Exception as e:
+				self.failed(message, e)
+			else:
+				message.status, message.sent_at, message.claim = 'sent', datetime.utcnow(), None
+				message.attempts += 1
+				self.sent += 1
+		db.session.commit()
+		return len(messages)
+
+	# a pooled session may have been dropped by the server since its last message, so a message that finds it
+	# disconnected is sent once more over a fresh one
+	def deliver(self, message, session):
+		msg = self.build(message)
+		if not self.reuse_connections:
+			mail.send(msg)
+			return
+		try:
+			session.send(msg)
+		except smtplib.SMTPServerDisconnected:
+			session.close()
+			session.send(msg)
+
+	@staticmethod
+	def build(message):
+		msg = Message(message.subject, sender=message.sender, recipients=json.loads(message.recipients))
+		msg.body = message.text_body
+		msg.html = message.html_body
+		return msg
+
+	def failed(self, message, error):
+		message.attempts += 1
+		message.last_error = repr(error)
+		message.claim = None
+		if message.attempts >= self.max_attempts:
+			message.status = 'dead'
+			self.dead += 1
+			self.app.logger.error('Giving up on mail %d to %s after %d attempts: %r', message.id, message.recipients,
+				message.attempts, error)
+		else:
+			message.status = 'pending'
+			message.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff * 2 ** (message.attempts - 1))
+			self.retried += 1
+
+	def release(self, message, error):
+		message.last_error = repr(error)
+		message.claim = None
+		message.status = 'pending'
+		message.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff)
+		self.retried += 1
+
+	# sends everything that is due in the foreground; with deferred=True also the messages waiting for a retry.
+	# returns how many messages were sent, deferred for a retry and given up on
+	def drain(self, deferred=False):
+		sent, retried, dead = self.sent, self.retried, self.dead
+		if deferred:
+			with db.engine.begin() as connection:
+				connection.execute(OutgoingMail.__table__.update().where(OutgoingMail.status == 'pending').values(
+					next_attempt_at=datetime.utcnow()))
+		session = SMTPSession()
+		try:
+			while True:
+				# a message that fails is only due again after its backoff, or is dead, so this ends
+				if not self.process_batch(session):
+					break
+		finally:
+			session.close()
+		return self.sent - sent, self.retried - retried, self.dead - dead
+
+
+mail_dispatcher = MailDispatcher()
 
-# sends email in background, so we can return to service in the foreground
-def send_async_email(app, msg):
-	with app.app_context():
-		mail.send(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body):
-	msg = Message(subject, sender=sender, recipients=recipients)
-	msg.body = text_body
-	msg.html = html_body
-	# asynchronous email send, because email sending can take a few seconds, which is way too slow
-	Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
+	# queued in the outbox and sent by the mail workers, because email sending can take a few seconds, which is way too slow
+	mail_dispatcher.enqueue(subject, sender, recipients, text_body, html_body)
@@ -0,0 +1,129 @@
+import logging
+import queue
+import smtplib
+import threading
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+from logging.handlers import QueueListener
+from app.logs import LogQueueHandler
+
+
+# the group an error is counted in: its exception type and the place it was raised, or for an error logged without
+# an exception, the place it was logged
+def error_key(record):
+	if record.exc_info and record.exc_info[0] is not None:
+		exc_type, exc, tb = record.exc_info
+		frames = traceback.extract_tb(tb)
+		if frames:
+			return exc_type.__name__, '{}:{}'.format(frames[-1].filename, frames[-1].lineno)
+		return exc_type.__name__, '{}:{}'.format(record.pathname, record.lineno)
+	return record.levelname, '{}:{}'.format(record.pathname, record.lineno)
+
+
+# the group of an error is worked out before LogQueueHandler drops its traceback
+class ErrorQueueHandler(LogQueueHandler):
+	def prepare(self, record):
+		key = error_key(record)
+		record = super().prepare(record)
+		record.error_key = key
+		return record
+
+
+class ErrorGroup(object):
+	def __init__(self, record):
+		self.record = record # the first one, whose message and traceback go into the mail
+		self.count = 0
+		self.first = self.last = datetime.utcnow()
+
+	def add(self):
+		self.count += 1
+		self.last = datetime.utcnow()
+
+
+# collects errors coming off the queue into groups for window seconds after the first one, then sends one mail per
+# group with how many times it happened. it talks to the mail server itself rather than going through the outbox in
+# app/email.py, which needs the database that may well be what is failing
+class ErrorDigestHandler(logging.Handler):
+	def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, secure=None, window=60, timeout=10):
+		super().__init__(logging.ERROR)
+		self.mailhost, self.mailport = mailhost
+		self.fromaddr = fromaddr
+		self.toaddrs = toaddrs
+		self.subject = subject
+		self.credentials = credentials
+		self.secure = secure
+		self.window = window
+		self.timeout = timeout
+		self.groups = OrderedDict() # (exception type, location) -> ErrorGroup
+		self.timer = None
+
+	def emit(self, record):
+		key = getattr(record, 'error_key', None) or error_key(record)
+		with self.lock:
+			group = self.groups.get(key)
+			if group is None:
+				group = self.groups[key] = ErrorGroup(record)
+			group.add()
+			if self.timer is None:
+				self.timer = threading.Timer(self.window, self.flush)
+				self.timer.daemon = True
+				self.timer.start()
+
+	def flush(self):
+		with self.lock:
+			groups, self.groups = self.groups, OrderedDict()
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+		for key, group in groups.items():
+			try:
+				self.send(key, group)
+			except Exception:
+				self.handleError(group.record)
+
+	def close(self):
+		self.flush()
+		super().close()
+
+	def send(self, key, group):
+		msg = EmailMessage()
+		msg['From'] = self.fromaddr
+		msg['To'] = ','.join(self.toaddrs)
+		msg['Subject'] = '{}: {} x {} at {}'.format(self.subject, group.count, key[0], key[1])
+		msg.set_content('{} at {} happened {} times between {:%Y-%m-%d %H:%M:%S} and {:%Y-%m-%d %H:%M:%S} UTC.\n\n'
+			'The first one:\n\n{}'.format(key[0], key[1], group.count, group.first, group.last,
+			self.format(group.record)))
+		smtp = smtplib.SMTP(self.mailhost, self.mailport, timeout=self.timeout)
+		try:
+			if self.credentials:
+				if self.secure is not None:
+					smtp.ehlo()
+					smtp.starttls(*self.secure)
+					smtp.ehlo()
+				smtp.login(*self.credentials)
+			smtp.send_message(msg)
+		finally:
+			smtp.quit()
+
+
+# returns a handler for app.logger that only puts ERROR records on a queue, so a request that logs an error never waits
+# on the mail server; a listener thread feeds them to an ErrorDigestHandler. what is still grouped when the process
+# exits is sent as logging closes its handlers
+def error_mail_handler(app):
+	auth = None
+	if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+		auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+	secure = None
+	if app.config['MAIL_USE_TLS']:
+		secure = ()
+	digest = ErrorDigestHandler(mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+		fromaddr='no-reply@' + app.config['MAIL_SERVER'], toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+		credentials=auth, secure=secure, window=app.config['ERROR_MAIL_WINDOW'])
+	records = queue.SimpleQueue()
+	listener = QueueListener(records, digest, respect_handler_level=True)
+	listener.start()
+	handler = ErrorQueueHandler(records, listener)
+	handler.setLevel(logging.ERROR)
+	return handler
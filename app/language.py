@@ -0,0 +1,322 @@
+# language detection for posts
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from langdetect import LangDetectException
+from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+from langdetect.utils.ngram import NGram
+from app import db
+from app.models import Post
+
+
+# langdetect.detect() builds a fresh Detector with an unseeded random sampler on every call, so the same short post
+# can come back as different languages. this backend loads the language profiles once per process and seeds every
+# detector with the same value, so a text always gets the same answer
+class LangdetectBackend(object):
+	def __init__(self, seed=0):
+		self.seed = seed
+		self.factory = None
+
+	def load(self):
+		if self.factory is None:
+			factory = DetectorFactory()
+			factory.load_profile(PROFILES_DIRECTORY)
+			factory.set_seed(self.seed)
+			self.factory = factory
+
+	# language codes, '' for a text with nothing to detect
+	def detect_many(self, texts):
+		self.load()
+		languages = []
+		for text in texts:
+			detector = self.factory.create()
+			detector.append(text)
+			try:
+				languages.append(detector.detect())
+			except LangDetectException:
+				languages.append('')
+		return languages
+
+
+# a naive Bayes classifier over langdetect's character 1-3 gram profiles, restricted to a handful of languages.
+# the n-grams of a whole batch are looked up in one pass, and the per-language scores of every text in the batch
+# come out of a single gather and segmented sum over a (n-grams x languages) log-probability matrix, instead of
+# langdetect's per-text random sampling loop. on the short posts of tests.py it agrees with langdetect on at least
+# 90% of texts (NgramBackendCase); python benchmarks.py language compares the throughput. needs numpy
+class NgramBackend(object):
+	SMOOTHING = 1e-7 # probability of an n-gram a language's profile has never seen
+
+	def __init__(self, languages):
+		self.languages = sorted(set(languages))
+		self.vocabulary = None
+		self.log_probabilities = None
+
+	def load(self):
+		if self.vocabulary is not None:
+			return
+		import numpy
+		profiles = []
+		for language in self.languages:
+			with open(os.path.join(PROFILES_DIRECTORY, language), encoding='utf-8') as f:
+				profiles.append(json.load(f))
+		vocabulary = {}
+		for profile in profiles:
+			for gram in profile['freq']:
+				if 1 <= len(gram) <= NGram.N_GRAM:
+					vocabulary.setdefault(gram, len(vocabulary))
+		probabilities = numpy.full((len(vocabulary), len(self.languages)), self.SMOOTHING)
+		for column, profile in enumerate(profiles):
+			for gram, count in profile['freq'].items():
+				if gram in vocabulary:
+					probabilities[vocabulary[gram], column] += count / profile['n_words'][len(gram) - 1]
+		self.log_probabilities = numpy.log(probabilities)
+		self.vocabulary = vocabulary
+
+	# indexes into the vocabulary of every known n-gram of the text, extracted the same way langdetect does
+	def grams(self, text):
+		indexes = []
+		ngram = NGram()
+		for ch in text:
+			ngram.add_char(ch)
+			if ngram.capitalword:
+				continue
+			for n in range(1, NGram.N_GRAM + 1):
+				gram = ngram.get(n)
+				if gram and gram in self.vocabulary:
+					indexes.append(self.vocabulary[gram])
+		return indexes
+
+	def detect_many(self, texts):
+		import numpy
+		self.load()
+		indexes, starts, found = [], [], []
+		for i, text in enumerate(texts):
+			grams = self.grams(text)
+			if grams:
+				starts.append(len(indexes))
+				found.append(i)
+				indexes.extend(grams)
+		languages = [''] * len(texts)
+		if found:
+			scores = numpy.add.reduceat(self.log_probabilities[numpy.array(indexes)], numpy.array(starts), axis=0)
+			for i, best in zip(found, scores.argmax(axis=1)):
+				languages[i] = self.languages[best]
+		return languages
+
+
+# the detection service used everywhere in the app: it sits in front of the configured backend and remembers
+# answers in an LRU keyed by a hash of the text, so repeated texts are free and a batch only sends the backend
+# each distinct text it has not seen yet
+class LanguageDetector(object):
+	def __init__(self, cache_size=10000, backend=None):
+		self.cache_size = cache_size
+		self.backend = backend or LangdetectBackend()
+		self.memo = OrderedDict() # sha1 of the text -> language, least recently used first
+		self.lock = threading.Lock()
+
+	def init_app(self, app):
+		self.cache_size = app.config['LANGUAGE_CACHE_SIZE']
+		if app.config['LANGUAGE_DETECTOR'] == 'ngram':
+			self.backend = NgramBackend(app.config['LANGUAGES'] + app.config['LANGUAGE_DETECTOR_EXTRA_LANGUAGES'])
+		else:
+			self.backend = LangdetectBackend()
+		with self.lock:
+			self.memo.clear()
+
+	def load(self):
+		self.backend.load()
+
+	@staticmethod
+	def key(text):
+		return hashlib.sha1(text.encode('utf-8')).digest()
+
+	def run(self, texts):
+		return self.backend.detect_many(texts)
+
+	def remember(self, keys, languages):
+		with self.lock:
+			for key, language in zip(keys, languages):
+				self.memo[key] = language
+				self.memo.move_to_end(key)
+			while len(self.memo) > self.cache_size:
+				self.memo.popitem(last=False)
+
+	# the language code, or '' when the text has nothing to detect
+	def detect(self, text):
+		return self.detect_many([text])[0]
+
+	def detect_many(self, texts):
+		keys = [self.key(text) for text in texts]
+		with self.lock:
+			known = {}
+			for key in keys:
+				if key in self.memo:
+					known[key] = self.memo[key]
+					self.memo.move_to_end(key)
+		missing = {key: text for key, text in zip(keys, texts) if key not in known}
+		if missing:
+			languages = self.run(list(missing.values()))
+			self.remember(missing.keys(), languages)
+			known.update(zip(missing.keys(), languages))
+		return [known[key] for key in keys]
+
+
+language_detector = LanguageDetector()
+
+
+def detect_language(text):
+	return language_detector.detect(text)
+
+
+# runs in every pool worker, so each process loads the profiles once up front
+def init_worker():
+	language_detector.load()
+
+
+# fills in the language of every post where it is NULL, or Post.UNDETECTABLE where none can be detected, so the next
+# run does not try those again.
+# posts are streamed in id order, chunk_size at a time; each chunk is detected across a pool of worker processes and
+# written back with one executemany UPDATE and its own commit, so an interrupted run keeps everything it finished
+# and can be resumed from the last reported id with after_id. progress(done, last_id) is called after every chunk
+def backfill_languages(chunk_size=1000, workers=None, after_id=0, progress=None):
+	missing = Post.language == None
+	update = Post.__table__.update().where(Post.id == db.bindparam('post_id')).values(language=db.bindparam('lang'))
+	done = 0
+	workers = workers or os.cpu_count()
+	if workers > 1:
+		pool = multiprocessing.Pool(workers, initializer=init_worker)
+	else:
+		pool = None
+	try:
+		while True:
+			rows = db.session.execute(db.select(Post.id, Post.body).where(missing & (Post.id > after_id)).order_by(
+				Post.id).limit(chunk_size)).all()
+			if not rows:
+				break
+			bodies = [body or '' for id, body in rows]
+			if pool:
+				languages = pool.map(detect_language, bodies, chunksize=max(1, len(bodies) // (workers * 4)))
+			else:
+				languages = language_detector.detect_many(bodies)
+			db.session.execute(update, [{'post_id': id, 'lang': lang or Post.UNDETECTABLE}
+				for (id, body), lang in zip(rows, languages)])
+			db.session.commit()
+			done += len(rows)
+			after_id = rows[-1][0]
+			if progress:
+				progress(done, after_id)
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+	return done
+
+
+# detects the language of new posts in background threads, so that submitting a post only costs its INSERT.
+# the queue is the post table itself: a post is written with language NULL and only gets a language once a worker
+# has detected it. posts still queued when a process stops are picked up by the sweep every process starts on a worker
+# thread after its first request. the sweeps of several processes claim the waiting posts a chunk at a time, as the
+# mail outbox does, so each chunk is detected by one of them; a chunk whose sweep died is claimed again once its
+# LANGUAGE_SWEEP_LEASE has run out. that makes detection at-least-once, and the UPDATE only touches rows that are
+# still NULL, so doing a post twice is harmless
+class LanguageWorker(object):
+	def __init__(self, app=None):
+		self.app = None
+		self.executor = None
+		self.futures = set()
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.app = app
+		self.chunk_size = app.config['LANGUAGE_CHUNK_SIZE']
+		self.lease = timedelta(seconds=app.config['LANGUAGE_SWEEP_LEASE'])
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+		self.executor = None
+		if app.config['LANGUAGE_WORKERS'] > 0:
+			self.executor = ThreadPoolExecutor(app.config['LANGUAGE_WORKERS'], thread_name_prefix='language')
+			if app.config['LANGUAGE_SWEEP']:
+				app.before_first_request(self.sweep)
+
+	# queue posts by id; call after the transaction that inserted them has committed
+	def submit(self, *ids):
+		if self.executor is None or not ids:
+			return
+		future = self.executor.submit(self.detect, ids)
+		with self.lock:
+			self.futures.add(future)
+		future.add_done_callback(self.done)
+
+	def done(self, future):
+		with self.lock:
+			self.futures.discard(future)
+		if future.exception() is not None:
+			self.app.logger.error('Language detection failed', exc_info=future.exception())
+
+	# queues a job that detects every post still waiting for its language; the request that triggers it does not wait
+	def sweep(self):
+		future = self.executor.submit(self.detect_waiting)
+		with self.lock:
+			self.futures.add(future)
+		future.add_done_callback(self.done)
+
+	# claims the waiting posts in id order, LANGUAGE_CHUNK_SIZE at a time, so it never holds more ids than that
+	def detect_waiting(self):
+		after_id = 0
+		while True:
+			with self.app.app_context():
+				try:
+					ids = self.claim(after_id)
+				finally:
+					db.session.remove()
+			if not ids:
+				return
+			self.detect(ids)
+			after_id = ids[-1]
+
+	# claims up to chunk_size waiting posts after after_id that no other sweep holds, and returns their ids
+	def claim(self, after_id):
+		now = datetime.utcnow()
+		token = uuid.uuid4().hex
+		table = Post.__table__
+		free = (table.c.language == None) & (table.c.id > after_id) & (
+			(table.c.language_claimed_until == None) | (table.c.language_claimed_until <= now))
+		ids = db.select(table.c.id).where(free).order_by(table.c.id).limit(self.chunk_size)
+		with db.engine.begin() as connection:
+			connection.execute(table.update().where(table.c.id.in_(ids.scalar_subquery()) & free).values(
+				language_claim=token, language_claimed_until=now + self.lease))
+		return [id for id, in db.session.execute(db.select(table.c.id).where(
+			table.c.language_claim == token).order_by(table.c.id))]
+
+	def detect(self, ids):
+		with self.app.app_context():
+			try:
+				rows = db.session.execute(db.select(Post.id, Post.body).where(
+					Post.id.in_(ids) & (Post.language == None))).all()
+				if rows:
+					update = Post.__table__.update().where(
+						(Post.id == db.bindparam('post_id')) & (Post.language == None)).values(
+						language=db.bindparam('lang'))
+					languages = language_detector.detect_many([body or '' for id, body in rows])
+					db.session.execute(update, [{'post_id': id, 'lang': lang or Post.UNDETECTABLE}
+						for (id, body), lang in zip(rows, languages)])
+					db.session.commit()
+			finally:
+				db.session.remove()
+
+	# blocks until everything queued so far has been detected
+	def wait(self):
+		with self.lock:
+			pending = list(self.futures)
+		wait(pending)
+
+
+language_worker = LanguageWorker()
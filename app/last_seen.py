@@ -0,0 +1,123 @@
+# write-behind buffer for User.last_seen
+# page views record the time here instead of committing it, so a read-only request does no writes at all.
+# the buffer keeps only the newest time per user and writes everything pending with one bulk UPDATE every
+# LAST_SEEN_FLUSH_INTERVAL seconds, whenever LAST_SEEN_BUFFER_SIZE users are waiting, and once more at shutdown.
+# with LAST_SEEN_FLUSHER the writes are made by a daemon thread, so they happen even when no requests come in;
+# without it by whichever request finds the buffer due. either way a failed write is logged and retried with the
+# next one, and never fails a page
+import atexit
+import threading
+from datetime import datetime, timedelta
+from time import monotonic
+from app import db
+from app.models import User
+from app.user_cache import user_cache
+
+
+class LastSeenBuffer(object):
+	def __init__(self, app=None):
+		self.app = None
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.last_flush = monotonic()
+		self.registered = False
+		self.thread = None
+		self.wakeup = threading.Event()
+		self.stopping = threading.Event()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.stop()
+		self.app = app
+		self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+		self.buffer_size = app.config['LAST_SEEN_BUFFER_SIZE']
+		# a stored last_seen younger than this is considered fresh enough, and the visit is not recorded at all
+		self.tolerance = timedelta(seconds=app.config['LAST_SEEN_TOLERANCE'])
+		self.background = app.config['LAST_SEEN_FLUSHER']
+		with self.lock:
+			self.pending = {}
+			self.last_flush = monotonic()
+		if not self.registered:
+			atexit.register(self.flush_at_exit)
+			self.registered = True
+
+	def record(self, user, now=None):
+		now = now or datetime.utcnow()
+		with self.lock:
+			if user.id not in self.pending and user.last_seen is not None and now - user.last_seen < self.tolerance:
+				return
+			self.pending[user.id] = now
+			full = len(self.pending) >= self.buffer_size
+			due = full or monotonic() - self.last_flush >= self.flush_interval
+		if self.background:
+			self.start()
+			if full:
+				self.wakeup.set()
+		elif due:
+			self.try_flush()
+
+	def start(self):
+		with self.lock:
+			if self.thread is not None and self.thread.is_alive(): # not alive in a forked worker
+				return
+			self.stopping = threading.Event()
+			self.thread = threading.Thread(target=self.run, name='last-seen', daemon=True)
+			self.thread.start()
+
+	def stop(self):
+		with self.lock:
+			thread, self.thread = self.thread, None
+			self.stopping.set()
+			self.wakeup.set()
+		if thread is not None:
+			thread.join()
+		self.wakeup.clear()
+
+	def run(self):
+		stopping = self.stopping
+		while not stopping.is_set():
+			self.wakeup.wait(self.flush_interval)
+			self.wakeup.clear()
+			with self.app.app_context():
+				self.try_flush()
+
+	# flush() for the callers that must not fail: the pending times stay in the buffer for the next attempt
+	def try_flush(self):
+		try:
+			return self.flush()
+		except Exception:
+			self.app.logger.exception('Could not flush buffered last_seen times')
+			return 0
+
+	# writes every pending last_seen in one executemany UPDATE, on its own connection so that it never
+	# commits whatever the request's session happens to be holding; returns the number of users written
+	def flush(self):
+		with self.lock:
+			pending, self.pending = self.pending, {}
+			self.last_flush = monotonic()
+		if not pending:
+			return 0
+		update = User.__table__.update().where(User.id == db.bindparam('user_id')).values(
+			last_seen=db.bindparam('seen'))
+		try:
+			with db.engine.begin() as connection:
+				connection.execute(update, [{'user_id': id, 'seen': seen} for id, seen in pending.items()])
+		except Exception:
+			# put the times back so the next flush retries them, unless a newer visit was recorded meanwhile
+			with self.lock:
+				for id, seen in pending.items():
+					self.pending.setdefault(id, seen)
+			raise
+		# the cached snapshots of these users still carry the old times, which the tolerance check would go by
+		user_cache.invalidate(*pending)
+		return len(pending)
+
+	def flush_at_exit(self):
+		if self.app is None:
+			return
+		with self.app.app_context():
+			self.try_flush()
+
+
+last_seen_buffer = LastSeenBuffer()
@@ -0,0 +1,98 @@
+import copy
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+
+# puts records on a queue for a QueueListener thread to write, so a request that logs never waits on the disk.
+# unlike QueueHandler it leaves the formatting to the handlers on the other side and only renders what cannot cross
+# the queue, the message arguments and the traceback. closing it, which logging does for every handler when the
+# process exits, stops the listener and closes its handlers
+class LogQueueHandler(QueueHandler):
+	def __init__(self, queue, listener):
+		super().__init__(queue)
+		self.listener = listener
+
+	def prepare(self, record):
+		record = copy.copy(record)
+		record.msg = record.message = record.getMessage()
+		record.args = None
+		if record.exc_info and not record.exc_text:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+		record.exc_info = None
+		return record
+
+	def close(self):
+		if self.listener is not None:
+			listener, self.listener = self.listener, None
+			listener.stop()
+			for handler in listener.handlers:
+				handler.close()
+		super().close()
+
+
+# one JSON object per line, for log shippers
+class JSONFormatter(logging.Formatter):
+	def format(self, record):
+		entry = {
+			'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+			'level': record.levelname,
+			'logger': record.name,
+			'message': record.getMessage(),
+			'path': record.pathname,
+			'line': record.lineno,
+			'thread': record.threadName,
+		}
+		if record.exc_info and not record.exc_text:
+			record.exc_text = self.formatException(record.exc_info)
+		if record.exc_text:
+			entry['exception'] = record.exc_text
+		return json.dumps(entry)
+
+
+def gzip_namer(name):
+	return name + '.gz'
+
+
+# called by the file handler on the listener thread when it rolls over, so compressing costs requests nothing
+def gzip_rotator(source, dest):
+	with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+		shutil.copyfileobj(f_in, f_out)
+	os.remove(source)
+
+
+# the file handler LOG_ROTATION asks for: 'size' rolls over at LOG_MAX_BYTES, 'time' every LOG_ROTATE_INTERVAL
+# LOG_ROTATE_WHEN. both keep LOG_BACKUP_COUNT rolled files, gzipped with LOG_COMPRESS
+def file_handler(app):
+	path = app.config['LOG_FILE']
+	os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+	if app.config['LOG_ROTATION'] == 'time':
+		handler = TimedRotatingFileHandler(path, when=app.config['LOG_ROTATE_WHEN'],
+			interval=app.config['LOG_ROTATE_INTERVAL'], backupCount=app.config['LOG_BACKUP_COUNT'], utc=True)
+	else:
+		handler = RotatingFileHandler(path, maxBytes=app.config['LOG_MAX_BYTES'],
+			backupCount=app.config['LOG_BACKUP_COUNT'])
+	if app.config['LOG_COMPRESS']:
+		handler.namer = gzip_namer
+		handler.rotator = gzip_rotator
+	if app.config['LOG_FORMAT'] == 'json':
+		handler.setFormatter(JSONFormatter())
+	else:
+		handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+	handler.setLevel(logging.INFO)
+	return handler
+
+
+# returns a handler for app.logger that queues INFO and above for a listener thread writing the log file
+def file_log_handler(app):
+	records = queue.SimpleQueue()
+	listener = QueueListener(records, file_handler(app), respect_handler_level=True)
+	listener.start()
+	handler = LogQueueHandler(records, listener)
+	handler.setLevel(logging.INFO)
+	return handler
@@ -1,22 +1,27 @@
 from app import db
 from app.main import bp
-from app.models import User, Post
+from app.models import User, Post, Timeline
 from app.main.forms import PostForm, EditProfileForm, EmptyForm
 
 from flask import current_app, render_template, flash, redirect, url_for, request, g, jsonify
 from flask_login import current_user, login_required
 from werkzeug.urls import url_parse
-from datetime import datetime
-from langdetect import detect, LangDetectException
+from time import monotonic
 from flask_babel import get_locale, _
-from app.translate import translate
+from app.translate import translate, translate_many, translator_client, single_flight, breaker
+from app.pagination import paginate
+from app.last_seen import last_seen_buffer
+from app.user_cache import user_cache
+from app.language import language_worker
+from app.translation_cache import translation_cache
+from app.translate_async import AsyncTranslator
 
 # The @before_request decorator from Flask register the decorated function to be executed right before the view function
 @bp.before_request
 def before_request():
 	if current_user.is_authenticated:
-		current_user.last_seen = datetime.utcnow()
-		db.session.commit()
+		# buffered and written in bulk later, so that viewing a page is not a write transaction
+		last_seen_buffer.record(current_user)
 	g.locale = str(get_locale())
 
 
@@ -27,20 +32,18 @@ def before_request():
 def index():
 	form = PostForm()
 	if form.validate_on_submit():
-		language = ''
-		try:
-			language = detect(form.post.data)
-		except LangDetectException:
-			language = ''
-		post = Post(body=form.post.data, author=current_user, language=language)
-		db.session.add(post)
+		# the language is detected by a background worker once the post is stored
+		post_id = current_user.add_post(form.body.data, None).id
 		db.session.commit()
+		user_cache.invalidate(current_user.id) # its posts_count has changed
+		language_worker.submit(post_id)
 		flash('Blog post submitted!')
 		return redirect(url_for('main.index'))
-	page = request.args.get('page', 1, type=int)
-	posts = current_user.followed_posts().paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-	next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-	prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
+	# authors are loaded in the same query, otherwise _post.html issues one SELECT per author on the page
+	posts = paginate(current_user.timeline().options(db.joinedload(Post.author)), Timeline.timestamp, Timeline.post_id, current_app.config['POSTS_PER_PAGE'],
+		before=request.args.get('before'), after=request.args.get('after'))
+	next_url = url_for('main.index', before=posts.next_cursor) if posts.has_next else None
+	prev_url = url_for('main.index', after=posts.prev_cursor) if posts.has_prev else None
 	return render_template('index.html', title='Home', form=form, posts=posts.items, next_url=next_url, prev_url=prev_url)
 
 
@@ -50,8 +53,12 @@ def index():
 @login_required
 def user(username):
 	user = User.query.filter_by(username=username).first_or_404()
+	posts = paginate(user.posts.options(db.joinedload(Post.author)), Post.timestamp, Post.id, current_app.config['POSTS_PER_PAGE'],
+		before=request.args.get('before'), after=request.args.get('after'))
+	next_url = url_for('main.user', username=user.username, before=posts.next_cursor) if posts.has_next else None
+	prev_url = url_for('main.user', username=user.username, after=posts.prev_cursor) if posts.has_prev else None
 	form = EmptyForm()
-	return render_template('user.html', user=user, posts=user.posts, form=form)
+	return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
@@ -62,6 +69,7 @@ def edit_profile():
 		current_user.username = form.username.data
 		current_user.about_me = form.about_me.data
 		db.session.commit()
+		user_cache.invalidate(current_user.id)
 		flash('Your changes have been saved.')
 		return redirect(url_for('main.index'))
 	elif request.method == 'GET':
@@ -84,6 +92,7 @@ def follow(username):
 			return redirect(url_for('main.user', username=username))
 		current_user.follow(user)
 		db.session.commit()
+		user_cache.invalidate(current_user.id, user.id)
 		flash('You are following {}!'.format(username))
 		return redirect(url_for('main.user', username=username))
 	else:
@@ -104,6 +113,7 @@ def unfollow(username):
 			return redirect(url_for('main.user', username=username))
 		current_user.unfollow(user)
 		db.session.commit()
+		user_cache.invalidate(current_user.id, user.id)
 		flash('You are not following {}.'.format(username))
 		return redirect(url_for('main.user', username=username))
 	else:
@@ -114,11 +124,11 @@ def unfollow(username):
 @login_required
 def explore():
 	# use request.args to get information of user request.
-	page = request.args.get('page', 1, type=int)
-	# paginate retrieves only the desired page of results
-	posts = Post.query.order_by(Post.timestamp.desc()).paginate(page, current_app.config['POSTS_PER_PAGE'], False)
-	next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-	prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
+	# paginate retrieves only the page of results next to the before/after cursor
+	posts = paginate(Post.query.options(db.joinedload(Post.author)), Post.timestamp, Post.id, current_app.config['POSTS_PER_PAGE'],
+		before=request.args.get('before'), after=request.args.get('after'))
+	next_url = url_for('main.explore', before=posts.next_cursor) if posts.has_next else None
+	prev_url = url_for('main.explore', after=posts.prev_cursor) if posts.has_prev else None
 	return render_template('index.html', title='Explore', posts=posts.items, next_url=next_url, prev_url=prev_url)
 
 
@@ -126,3 +136,59 @@ def explore():
 @login_required
 def translate_text():
 	return jsonify({'text': translate(request.form['text'], request.form['source_language'], request.form['dest_language'])})
+
+
+# /translate on asyncio, see app/translate_async.py. Flask-Login 0.5's login_required cannot wrap a coroutine, so the
+# check is made here
+@bp.route('/translate/async', methods=['POST'])
+async def translate_text_async():
+	if not current_user.is_authenticated:
+		return current_app.login_manager.unauthorized()
+	translator = AsyncTranslator(current_app.config)
+	try:
+		text = await translator.translate(request.form['text'], request.form['source_language'], request.form['dest_language'])
+	finally:
+		await translator.aclose()
+	return jsonify({'text': text})
+
+
+# translates many posts at once: takes {"items": [{"post_id": 1, "source": "es", "dest": "en"}, ...]} and returns
+# {"translations": {"1": "...", ...}}. the items are grouped by language pair and each pair costs at most one
+# upstream request per MS_TRANSLATOR_BATCH_SIZE posts that are not in the translation cache yet, and all of them
+# together wait no longer than MS_TRANSLATOR_DEADLINE seconds.
+# a body that is not of that shape, or has more than MS_TRANSLATOR_BATCH_MAX items, is answered with a 400
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_batch():
+	data = request.get_json(silent=True)
+	items = data.get('items') if isinstance(data, dict) else None
+	if isinstance(items, list) and len(items) > current_app.config['MS_TRANSLATOR_BATCH_MAX']:
+		return jsonify({'error': 'at most {} items per request'.format(current_app.config['MS_TRANSLATOR_BATCH_MAX'])}), 400
+	if not isinstance(items, list) or not all(valid_batch_item(item) for item in items):
+		return jsonify({'error': 'items must be a list of {post_id, source, dest}'}), 400
+	groups = {}
+	for item in items:
+		groups.setdefault((item['source'], item['dest']), []).append(item['post_id'])
+	bodies = dict(db.session.execute(db.select(Post.id, Post.body).where(
+		Post.id.in_([id for ids in groups.values() for id in ids]))).all())
+	translations = {}
+	deadline = monotonic() + current_app.config['MS_TRANSLATOR_DEADLINE'] # for the whole batch, not for each pair
+	for (source, dest), ids in groups.items():
+		ids = [id for id in ids if id in bodies]
+		for id, text in zip(ids, translate_many([bodies[id] for id in ids], source, dest, deadline)):
+			translations[str(id)] = text
+	return jsonify({'translations': translations})
+
+
+def valid_batch_item(item):
+	return isinstance(item, dict) and type(item.get('post_id')) is int and \
+		all(isinstance(item.get(name), str) and item[name] for name in ('source', 'dest'))
+
+
+# hit rates of this process's translation cache, connection reuse of its translator client, how many requests
+# shared an upstream call and the state of the circuit breaker
+@bp.route('/translate/stats')
+@login_required
+def translate_stats():
+	return jsonify(dict(translation_cache.stats(), http=translator_client.stats(), coalescing=single_flight.stats(),
+		breaker=breaker.stats()))
@@ -7,12 +7,16 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
 from flask import current_app, url_for
-from langdetect import detect, LangDetectException
+from sqlalchemy.dialects import postgresql, sqlite
+from app.user_cache import user_cache
+from app.follow_graph import follow_graph
 
 # columns in tables can be accessed with Table.c.wanted_column or Table.column.wanted_column
+# the primary key doubles as the index for "who does X follow", the second index answers "who follows X"
 followers = db.Table('followers',
-	db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-	db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+	db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+	db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+	db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 # this class inherits from db.Model, a base class for all models
@@ -34,6 +38,11 @@ class User(UserMixin, db.Model):
 	about_me = db.Column(db.String(140))
 	last_seen = db.Column(db.DateTime, default=datetime.utcnow)
 
+	# denormalized counts shown on the profile page, kept exact by follow, unfollow and add_post
+	followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
 	followed = db.relationship('User', # Right side of this relationship. Follower or followed is another user
 		secondary=followers, # configures association table with this relationship
 		primaryjoin=(followers.c.follower_id == id), # links the left side with table
@@ -50,34 +59,95 @@ class User(UserMixin, db.Model):
 	def check_password(self, password):
 		return check_password_hash(self.password_hash, password)
 
+	# a single INSERT ... ON CONFLICT DO NOTHING, so following someone twice is a no-op without a separate check, even
+	# when two requests do it at the same time. databases without it get INSERT ... SELECT ... WHERE NOT EXISTS.
+	# the rowcount tells whether a row was really added, and only then are the counters and timeline touched
 	def follow(self, user):
-		if not self.is_following(user):
-			self.followed.append(user)
+		dialects = {'postgresql': postgresql, 'sqlite': sqlite}
+		dialect = dialects.get(db.engine.dialect.name)
+		if dialect is not None:
+			insert = dialect.insert(followers).values(follower_id=self.id, followed_id=user.id).on_conflict_do_nothing()
+		else:
+			row = db.select(db.literal(self.id), db.literal(user.id)).where(~self.following_clause(user))
+			insert = followers.insert().from_select(['follower_id', 'followed_id'], row)
+		if db.session.execute(insert).rowcount:
+			self.bump('following_count', 1)
+			user.bump('followers_count', 1)
+			Timeline.backfill(self, user)
+			follow_graph.stage(db.session, 'add', self.id, user.id)
 
 	def unfollow(self, user):
-		if self.is_following(user):
-			self.followed.remove(user)
+		if db.session.execute(followers.delete().where(
+				(followers.c.follower_id == self.id) & (followers.c.followed_id == user.id))).rowcount:
+			self.bump('following_count', -1)
+			user.bump('followers_count', -1)
+			Timeline.trim(self, user)
+			follow_graph.stage(db.session, 'remove', self.id, user.id)
+
+	# counters are changed with UPDATE ... SET n = n + delta inside the caller's transaction, so concurrent
+	# requests never overwrite each other's increments; the stale in-memory value is expired and reloaded on next use
+	def bump(self, counter, delta):
+		db.session.execute(User.__table__.update().where(User.id == self.id).values(
+			{counter: getattr(User, counter) + delta}))
+		db.session.expire(self, [counter])
+
+	# recomputes every counter from the followers and post tables and returns the number of users that had drifted
+	@staticmethod
+	def reconcile_counters():
+		followers_count = db.select(db.func.count()).where(followers.c.followed_id == User.id).scalar_subquery()
+		following_count = db.select(db.func.count()).where(followers.c.follower_id == User.id).scalar_subquery()
+		posts_count = db.select(db.func.count()).where(Post.user_id == User.id).scalar_subquery()
+		result = db.session.execute(User.__table__.update().where(
+			(User.followers_count != followers_count) | (User.following_count != following_count) |
+			(User.posts_count != posts_count)).values(
+			followers_count=followers_count, following_count=following_count, posts_count=posts_count))
+		return result.rowcount
 
+	def following_clause(self, user):
+		return db.exists().where((followers.c.follower_id == self.id) & (followers.c.followed_id == user.id))
+
+	# one primary key lookup, instead of counting every matching row, or no query at all with the follow graph
 	def is_following(self, user):
-		return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+		if follow_graph.enabled:
+			return follow_graph.is_following(self.id, user.id)
+		return db.session.query(self.following_clause(user)).scalar()
+
+	# ids of the users whose posts make up this user's home page, the followed users plus the user themselves.
+	# always a subquery, even with the follow graph: binding every followee id would hit the database's limit on
+	# bound parameters for users who follow many others
+	def followed_ids(self):
+		return db.select(followers.c.followed_id).where(followers.c.follower_id == self.id).union(
+			db.select(db.literal(self.id)))
 
+	# one query instead of a UNION of the followed and own posts, so there is no dedup sort over every candidate
+	# and the database can walk the timestamp index newest first and stop as soon as it has a page
 	def followed_posts(self):
-		followed = Post.query.join( # join creates a temporary table with posts from all the users followed by another user
-			followers, (followers.c.followed_id == Post.user_id)).filter( # find the posts from users followed by this user
-				followers.c.follower_id == self.id)
-		own = Post.query.filter_by(user_id=self.id)
-		return followed.union(own).order_by(Post.timestamp.desc())
+		return Post.query.filter(Post.user_id.in_(self.followed_ids())).order_by(
+			Post.timestamp.desc(), Post.id.desc())
+
+	# same posts as followed_posts(), but read from the materialized timeline with a single range scan
+	def timeline(self):
+		return Post.query.join(Timeline, Timeline.post_id == Post.id).filter(
+			Timeline.user_id == self.id).order_by(Timeline.timestamp.desc(), Timeline.post_id.desc())
+
+	def add_post(self, body, language):
+		post = Post(body=body, author=self, language=language)
+		db.session.add(post)
+		db.session.flush() # the post needs its id and timestamp before it can be copied into timelines
+		post.fan_out()
+		self.bump('posts_count', 1)
+		return post
 
 	def get_reset_password_token(self, expires_in=600):
 		return jwt.encode({'reset_password': self.id, # first payload
 			'exp': time() + expires_in}, # exp field is standard for jwt, and
-			flask_app.config['SECRET_KEY'],
+			current_app.config['SECRET_KEY'],
 			algorithm='HS256') # HS256 is widely used for encoding
 
 	@staticmethod
 	def verify_reset_password_token(token):
 		try:
-			id = jwt.decode(token, flask_app.config['SECRET_KEY'],
+			id = jwt.decode(token, current_app.config['SECRET_KEY'],
 				algorithms=['HS256'])['reset_password']
 		except:
 			return
@@ -105,27 +175,121 @@ class Post(db.Model):
 	# initializes user_id as a foreign key to user.id, referencing id from th user table. this particular call utilizes the database table name for the model instead of the name of the model class defined above
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
-	language = db.Column(db.String(5), default = 'en')
+	# NULL until app.language has detected it in the background, UNDETECTABLE once it has found no language in the post
+	language = db.Column(db.String(5))
+	UNDETECTABLE = 'und' # ISO 639-2 for undetermined
+	# the sweep of app.language that has claimed the post, and until when
+	language_claim = db.Column(db.String(32))
+	language_claimed_until = db.Column(db.DateTime)
+
+	# profile pages read one user's posts newest first
+	__table_args__ = (db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
+	# posts still waiting for the background worker are detected on the spot, through the memoized detector.
+	# '' for a post of no detectable language
 	def get_language(self):
+		if self.language == self.UNDETECTABLE:
+			return ''
 		if self.language is not None:
 			return self.language
-		l = ''
-		try:
-			l = detect(self.body)
-		except LangDetectException:
-			l = ''
-		return l
+		from app.language import language_detector
+		return language_detector.detect(self.body or '')
 	def __repr__(self):
 		return '<Post {}>'.format(self.body)
 
+	# fan-out-on-write: copy the post into its author's timeline and into the timeline of every follower
+	def fan_out(self):
+		db.session.execute(Timeline.__table__.insert().values(
+			user_id=self.user_id, post_id=self.id, author_id=self.user_id, timestamp=self.timestamp))
+		readers = db.select(followers.c.follower_id, db.literal(self.id), db.literal(self.user_id),
+			db.literal(self.timestamp)).where(followers.c.followed_id == self.user_id)
+		db.session.execute(Timeline.__table__.insert().from_select(Timeline.COLUMNS, readers))
+
 
+# materialized home timeline, one row per (reader, post)
+# author_id and timestamp are copied from the post so that reading and trimming a timeline never touches the post table
+class Timeline(db.Model):
+	COLUMNS = ['user_id', 'post_id', 'author_id', 'timestamp']
 
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+	post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+	author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	timestamp = db.Column(db.DateTime)
+
+	__table_args__ = (
+		db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'post_id'), # home page reads
+		db.Index('ix_timeline_user_id_author_id', 'user_id', 'author_id'), # trimming on unfollow
+	)
+
+	# copies all of the followed user's existing posts into the follower's timeline
+	@staticmethod
+	def backfill(follower, followed):
+		posts = db.select(db.literal(follower.id), Post.id, Post.user_id, Post.timestamp).where(
+			Post.user_id == followed.id)
+		db.session.execute(Timeline.__table__.insert().from_select(Timeline.COLUMNS, posts))
 
+	@staticmethod
+	def trim(follower, followed):
+		db.session.execute(Timeline.__table__.delete().where(
+			(Timeline.user_id == follower.id) & (Timeline.author_id == followed.id)))
+
+	# throws away every timeline and regenerates them from the post and followers tables
+	@staticmethod
+	def rebuild():
+		db.session.execute(Timeline.__table__.delete())
+		own = db.select(Post.user_id, Post.id, Post.user_id.label('author_id'), Post.timestamp)
+		db.session.execute(Timeline.__table__.insert().from_select(Timeline.COLUMNS, own))
+		followed = db.select(followers.c.follower_id, Post.id, Post.user_id, Post.timestamp).distinct().join(
+			followers, followers.c.followed_id == Post.user_id).where(followers.c.follower_id != Post.user_id)
+		db.session.execute(Timeline.__table__.insert().from_select(Timeline.COLUMNS, followed))
+
+
+# second tier of the translation cache in app/translation_cache.py, shared by every process
+class CachedTranslation(db.Model):
+	__tablename__ = 'translation_cache'
+	text_hash = db.Column(db.String(40), primary_key=True) # sha1 of the source text
+	source = db.Column(db.String(5), primary_key=True)
+	dest = db.Column(db.String(5), primary_key=True)
+	translation = db.Column(db.Text)
+	created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+	def __repr__(self):
+		return '<CachedTranslation {} {}->{}>'.format(self.text_hash, self.source, self.dest)
+
+
+# durable queue of outgoing mail, sent by the workers in app/email.py
+class OutgoingMail(db.Model):
+	__tablename__ = 'mail_outbox'
+	id = db.Column(db.Integer, primary_key=True)
+	subject = db.Column(db.String(255))
+	sender = db.Column(db.String(120))
+	recipients = db.Column(db.Text) # json list of addresses
+	text_body = db.Column(db.Text)
+	html_body = db.Column(db.Text)
+	status = db.Column(db.String(10), nullable=False, default='pending') # pending, sending, sent or dead
+	attempts = db.Column(db.Integer, nullable=False, default=0)
+	# when a pending message is due, or when the claim of a message being sent runs out
+	next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+	claim = db.Column(db.String(32)) # token of the worker sending it
+	last_error = db.Column(db.Text)
+	created_at = db.Column(db.DateTime, default=datetime.utcnow)
+	sent_at = db.Column(db.DateTime)
+
+	__table_args__ = (db.Index('ix_mail_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+	def __repr__(self):
+		return '<OutgoingMail {} {}>'.format(self.id, self.status)
 
 
 # flask_login keeps track of the current user by storing its unique identifier in flask's "user session", a storage space assigned to each user who connects to the application.
 # user_loader is used to load user classes into such sessions, and must be defined by us because flask_login doesn't know how the Classes are implemented
+# a cached snapshot is merged into the session without loading it, so most requests never query the user table
 @login.user_loader
 def load_user(id):
-	return User.query.get(int(id))
+	cached = user_cache.get(int(id))
+	if cached is not None:
+		return db.session.merge(cached, load=False)
+	user = User.query.get(int(id))
+	if user is not None:
+		user_cache.put(user)
+	return user
@@ -0,0 +1,59 @@
+# keyset (cursor) pagination
+# instead of OFFSET, a page is addressed by the (timestamp, id) of the post at its edge, so every page is a single
+# index range scan that stops after per_page + 1 rows, no matter how deep it is, and no COUNT(*) is ever needed
+import base64
+import binascii
+from datetime import datetime
+from app import db
+
+
+# cursors are opaque to the client: urlsafe base64 of "<iso timestamp>|<id>"
+def encode_cursor(post):
+	raw = '{}|{}'.format(post.timestamp.isoformat(), post.id)
+	return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# returns (timestamp, id), or None if the cursor is missing or malformed
+def decode_cursor(cursor):
+	if not cursor:
+		return None
+	try:
+		raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+		timestamp, id = raw.split('|')
+		return datetime.fromisoformat(timestamp), int(id)
+	except (binascii.Error, UnicodeDecodeError, ValueError):
+		return None
+
+
+class KeysetPage(object):
+	def __init__(self, items, has_next, has_prev):
+		self.items = items
+		self.has_next = has_next
+		self.has_prev = has_prev
+
+	# cursor for the page of older posts
+	@property
+	def next_cursor(self):
+		return encode_cursor(self.items[-1]) if self.items else None
+
+	# cursor for the page of newer posts
+	@property
+	def prev_cursor(self):
+		return encode_cursor(self.items[0]) if self.items else None
+
+
+# paginates a query of posts newest first, ordered by (timestamp_column, id_column)
+# pass before= to walk towards older posts and after= to walk back towards newer ones
+def paginate(query, timestamp_column, id_column, per_page, before=None, after=None):
+	key = db.tuple_(timestamp_column, id_column)
+	query = query.order_by(None)
+	after = decode_cursor(after)
+	if after is not None:
+		# walk forward in ascending order from the cursor, then flip the page back to newest first
+		rows = query.filter(key > after).order_by(timestamp_column.asc(), id_column.asc()).limit(per_page + 1).all()
+		return KeysetPage(rows[:per_page][::-1], True, len(rows) > per_page)
+	before = decode_cursor(before)
+	if before is not None:
+		query = query.filter(key < before)
+	rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+	return KeysetPage(rows[:per_page], len(rows) > per_page, before is not None)
@@ -0,0 +1,73 @@
+import os
+import tempfile
+from jinja2 import FileSystemBytecodeCache
+
+
+# several workers share the directory, so a template is written to a temporary file and moved into place, and no
+# worker reads one that is half written. the cache only saves compile time, so failing to write it is not an error
+class SharedBytecodeCache(FileSystemBytecodeCache):
+	def dump_bytecode(self, bucket):
+		try:
+			fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+			try:
+				with os.fdopen(fd, 'wb') as f:
+					bucket.write_bytecode(f)
+				os.replace(path, self._get_cache_filename(bucket))
+			except BaseException:
+				os.remove(path)
+				raise
+		except OSError:
+			pass
+
+
+# false for hidden files such as .DS_Store, which are not templates
+def not_hidden(name):
+	return not os.path.basename(name).startswith('.')
+
+
+# keeps the compiled templates in TEMPLATE_CACHE_DIR, so a fresh worker loads them instead of parsing and compiling
+# base.html, the pages and the bootstrap and wtf templates again on its first requests. jinja checks every cached
+# template against the checksum of its source, so a changed template is compiled again whatever is in the directory.
+# flask templates precompile fills the directory at deploy time
+class TemplateCache(object):
+	def __init__(self, app=None):
+		self.bytecode_cache = None
+		if app is not None:
+			self.init_app(app)
+
+	# has to run before anything touches app.jinja_env, which is built from app.jinja_options on first use. a directory
+	# that cannot be created only costs compile time, so the app then runs without the cache
+	def init_app(self, app):
+		directory = app.config['TEMPLATE_CACHE_DIR']
+		self.bytecode_cache = None
+		if directory:
+			try:
+				os.makedirs(directory, exist_ok=True)
+			except OSError as e:
+				app.logger.warning('Running without a template cache, cannot create %s: %s', directory, e)
+				return
+			self.bytecode_cache = SharedBytecodeCache(directory)
+			app.jinja_options = dict(app.jinja_options, bytecode_cache=self.bytecode_cache)
+
+	# compiles every template the app can find, its own and those of the extensions, into the cache, skipping hidden
+	# files such as .DS_Store. returns the names of the compiled templates and a list of (name, error) for the ones that
+	# did not compile
+	def precompile(self, app):
+		compiled, failed = [], []
+		if app.jinja_env.cache is not None:
+			app.jinja_env.cache.clear() # a template loaded already would not be looked up in the cache again
+		for name in app.jinja_env.list_templates(filter_func=not_hidden):
+			try:
+				app.jinja_env.get_template(name)
+			except Exception as e:
+				failed.append((name, e))
+			else:
+				compiled.append(name)
+		return compiled, failed
+
+	def clear(self):
+		if self.bytecode_cache is not None:
+			self.bytecode_cache.clear()
+
+
+template_cache = TemplateCache()
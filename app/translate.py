@@ -1,17 +1,372 @@
 import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from time import monotonic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask_babel import _
 from flask import current_app
+from app.translation_cache import translation_cache
 
-def translate(text, source_language, dest_language):
-	if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
-		return _('Error: the translation service is not configured.')
+
+# one keep-alive requests.Session per process for every call to the translator, so a translation reuses a pooled
+# connection instead of paying for DNS, TCP and TLS each time. calls time out after MS_TRANSLATOR_CONNECT_TIMEOUT and
+# MS_TRANSLATOR_READ_TIMEOUT seconds; connection errors, timeouts and 429/5xx answers are retried
+# MS_TRANSLATOR_RETRIES times with exponential backoff. a translation is the same whenever it is asked for, so the
+# POST is safe to retry
+class TranslatorClient(object):
+	RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+	def __init__(self, app=None):
+		self.session = None
+		self.executor = None
+		self.pid = None
+		self.lock = threading.Lock()
+		self.reset_stats()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.pool_size = app.config['MS_TRANSLATOR_POOL_SIZE']
+		self.timeout = (app.config['MS_TRANSLATOR_CONNECT_TIMEOUT'], app.config['MS_TRANSLATOR_READ_TIMEOUT'])
+		self.retries = app.config['MS_TRANSLATOR_RETRIES']
+		self.backoff = app.config['MS_TRANSLATOR_BACKOFF']
+		self.close()
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.calls = 0
+		self.errors = 0
+
+	# the session and the threads that use it are made on first use in each process, so a forked worker never shares
+	# its parent's sockets
+	def get_session(self):
+		with self.lock:
+			if self.session is None or self.pid != os.getpid():
+				retry = Retry(total=self.retries, backoff_factor=self.backoff, status_forcelist=self.RETRY_STATUSES,
+					allowed_methods=frozenset(['POST']), raise_on_status=False)
+				session = requests.Session()
+				session.mount('https://', HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry))
+				session.mount('http://', HTTPAdapter(pool_maxsize=self.pool_size, max_retries=retry))
+				self.session, self.pid = session, os.getpid()
+				self.executor = ThreadPoolExecutor(self.pool_size, thread_name_prefix='translator')
+			return self.session
+
+	def close(self):
+		with self.lock:
+			if self.session is not None and self.pid == os.getpid():
+				self.session.close()
+				self.executor.shutdown(wait=False)
+			self.session = None
+			self.executor = None
+
+	# runs fn on one of the client's threads, so the caller can stop waiting for it without killing the call
+	def submit(self, fn):
+		self.get_session()
+		return self.executor.submit(fn)
+
+	def post(self, url, **kwargs):
+		session = self.get_session()
+		self.calls += 1
+		try:
+			return session.post(url, timeout=self.timeout, **kwargs)
+		except requests.RequestException:
+			self.errors += 1
+			raise
+
+	# connections opened against requests sent over them, across every pool of the session
+	def stats(self):
+		connections = requests_sent = 0
+		if self.session is not None:
+			for adapter in self.session.adapters.values():
+				for key in adapter.poolmanager.pools.keys():
+					pool = adapter.poolmanager.pools.get(key)
+					if pool is not None:
+						connections += pool.num_connections
+						requests_sent += pool.num_requests
+		return {'calls': self.calls, 'errors': self.errors, 'requests': requests_sent, 'connections': connections,
+			'reuse_rate': 1 - connections / requests_sent if requests_sent else 0.0}
+
+
+translator_client = TranslatorClient()
+
+
+# stops calling the translator while it keeps failing or answering slowly, so that requests fail fast instead of
+# each one tying up a worker on it. every call lands in a rolling window of the last MS_TRANSLATOR_BREAKER_WINDOW
+# seconds, and a call slower than MS_TRANSLATOR_BREAKER_SLOW_CALL seconds counts as a failure. once the window holds
+# MS_TRANSLATOR_BREAKER_MIN_CALLS calls or more and at least MS_TRANSLATOR_BREAKER_ERROR_RATE of them failed, the
+# circuit opens and nothing is sent for MS_TRANSLATOR_BREAKER_COOLDOWN seconds. then it is half-open: one trial call
+# goes through, closing the circuit if it succeeds and opening it again if it fails
+class CircuitBreaker(object):
+	CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+	def __init__(self, app=None):
+		self.lock = threading.Lock()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.window = app.config['MS_TRANSLATOR_BREAKER_WINDOW']
+		self.min_calls = app.config['MS_TRANSLATOR_BREAKER_MIN_CALLS']
+		self.error_rate = app.config['MS_TRANSLATOR_BREAKER_ERROR_RATE']
+		self.slow_call = app.config['MS_TRANSLATOR_BREAKER_SLOW_CALL']
+		self.cooldown = app.config['MS_TRANSLATOR_BREAKER_COOLDOWN']
+		self.logger = app.logger
+		with self.lock:
+			self.state = self.CLOSED
+			self.calls = deque() # (finished at, failed) of the calls in the window
+			self.failures = 0 # failed calls in the window
+			self.opened_at = 0
+			self.probing = False
+			self.transitions = {self.OPEN: 0, self.HALF_OPEN: 0, self.CLOSED: 0}
+			self.rejected = 0
+
+	# whether a call may go out now; every call let through must be followed by record()
+	def allow(self):
+		with self.lock:
+			if self.state == self.OPEN:
+				if monotonic() - self.opened_at < self.cooldown:
+					self.rejected += 1
+					return False
+				self.move(self.HALF_OPEN)
+			if self.state == self.HALF_OPEN:
+				if self.probing:
+					self.rejected += 1
+					return False
+				self.probing = True
+			return True
+
+	def record(self, failed, duration):
+		failed = failed or duration > self.slow_call
+		now = monotonic()
+		with self.lock:
+			if self.state == self.HALF_OPEN:
+				self.probing = False
+				self.move(self.OPEN if failed else self.CLOSED)
+				return
+			if self.state == self.OPEN:
+				return # let through before the circuit opened
+			self.calls.append((now, failed))
+			self.failures += failed
+			while self.calls[0][0] < now - self.window:
+				self.failures -= self.calls.popleft()[1]
+			if len(self.calls) >= self.min_calls and self.failures >= self.error_rate * len(self.calls):
+				self.move(self.OPEN)
+
+	# called with the lock held
+	def move(self, state):
+		self.logger.warning('Translator circuit breaker %s -> %s', self.state, state)
+		self.state = state
+		self.transitions[state] += 1
+		if state == self.OPEN:
+			self.opened_at = monotonic()
+		elif state == self.CLOSED:
+			self.calls.clear()
+			self.failures = 0
+
+	def is_open(self):
+		return self.state != self.CLOSED
+
+	def stats(self):
+		with self.lock:
+			return {'state': self.state, 'window_calls': len(self.calls),
+				'window_failures': self.failures, 'rejected': self.rejected,
+				'opened': self.transitions[self.OPEN], 'half_opened': self.transitions[self.HALF_OPEN],
+				'closed': self.transitions[self.CLOSED]}
+
+
+breaker = CircuitBreaker()
+
+
+# posts texts to the translator in one request; returns their translations in the same order, or None on failure.
+# the breaker hears about every call it let through, whatever happens: a call counts as failed unless it gave
+# translations, or was turned down with a 4xx, which says the translator itself is fine.
+# a call that outlives the request's deadline is left for the request to report to the breaker, see fetch_before
+def request_translations(texts, source_language, dest_language, deadline=None):
+	if not breaker.allow():
+		return None
 	auth = {'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
 		'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION']}
-	r = requests.post('https://api.cognitive.microsofttranslator.com'
-		'/translate?api-version=3.0&from={}&to={}'.format(
-			source_language, dest_language), headers=auth, json=[{'Text': text}])
-	if r.status_code != 200:
-		return text+' '+source_language+' '+dest_language
-		#return _('Error: the translation service failed.')
-	return r.json()[0]['translations'][0]['text']
+	start = monotonic()
+	r = translations = None
+	try:
+		r = translator_client.post(current_app.config['MS_TRANSLATOR_URL'] +
+			'/translate?api-version=3.0&from={}&to={}'.format(
+				source_language, dest_language), headers=auth, json=[{'Text': text} for text in texts])
+		if r.status_code == 200:
+			translations = parse_translations(r, len(texts))
+	except requests.RequestException as e:
+		current_app.logger.warning('Translator request failed: %s', e)
+	finally:
+		if deadline is None or monotonic() <= deadline:
+			breaker.record(translations is None and not is_client_error(r), monotonic() - start)
+	return translations
+
+
+def is_client_error(r):
+	return r is not None and 400 <= r.status_code < 500 and r.status_code not in TranslatorClient.RETRY_STATUSES
+
+
+# the translations in the translator's answer, or None when it is not one
+def parse_translations(r, count):
+	try:
+		translations = [item['translations'][0]['text'] for item in r.json()]
+	except (ValueError, KeyError, IndexError, TypeError) as e:
+		current_app.logger.warning('Translator sent an answer that could not be read: %r', e)
+		return None
+	if len(translations) != count or not all(isinstance(translation, str) for translation in translations):
+		current_app.logger.warning('Translator sent %d translations for %d texts', len(translations), count)
+		return None
+	return translations
+
+
+# lets concurrent callers asking for the same translation share one upstream call: the first to begin() a key
+# becomes its leader and makes the call, the rest follow it and wait() for its result. a follower gives up after
+# MS_TRANSLATOR_COALESCE_WAIT seconds and calls upstream itself, so a stalled leader only holds others back so long.
+# 0 turns coalescing off. flights only live in one process; across processes the translation cache does the job
+class Flight(object):
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+
+
+class SingleFlight(object):
+	def __init__(self, app=None):
+		self.flights = {}
+		self.lock = threading.Lock()
+		self.timeout = 0
+		self.reset_stats()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.timeout = app.config['MS_TRANSLATOR_COALESCE_WAIT']
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.leaders = 0
+		self.followers = 0
+		self.timeouts = 0
+
+	# returns the flight for key and whether the caller leads it
+	def begin(self, key):
+		with self.lock:
+			flight = self.flights.get(key)
+			if flight is not None and self.timeout > 0:
+				self.followers += 1
+				return flight, False
+			flight = Flight()
+			if self.timeout > 0:
+				self.flights[key] = flight
+			self.leaders += 1
+			return flight, True
+
+	# called by the leader whatever happened, with None when the call failed
+	def finish(self, key, flight, result):
+		with self.lock:
+			if self.flights.get(key) is flight:
+				del self.flights[key]
+		flight.result = result
+		flight.done.set()
+
+	# (True, the leader's result) or (False, None) when the wait ran out or the deadline passed
+	def wait(self, flight, deadline):
+		if flight.done.wait(max(0, min(self.timeout, deadline - monotonic()))):
+			return True, flight.result
+		with self.lock:
+			self.timeouts += 1
+		return False, None
+
+	# callers per upstream call
+	def stats(self):
+		return {'leaders': self.leaders, 'followers': self.followers, 'timeouts': self.timeouts,
+			'collapse_ratio': (self.leaders + self.followers) / self.leaders if self.leaders else 0.0}
+
+
+single_flight = SingleFlight()
+
+
+# successful translations of texts, sent upstream in requests of up to MS_TRANSLATOR_BATCH_SIZE texts (the translator
+# takes at most 100) and stored in the translation cache
+def fetch_translations(texts, source_language, dest_language, deadline=None):
+	fetched = {}
+	size = current_app.config['MS_TRANSLATOR_BATCH_SIZE']
+	for start in range(0, len(texts), size):
+		if deadline is not None and monotonic() > deadline:
+			break
+		chunk = texts[start:start + size]
+		translations = request_translations(chunk, source_language, dest_language, deadline)
+		if translations is not None:
+			translation_cache.put_many(dict(zip(chunk, translations)), source_language, dest_language)
+			fetched.update(zip(chunk, translations))
+	return fetched
+
+
+# fetch_translations on the client's threads, waited for until the deadline at most. a call still running then is
+# reported to the breaker as failed, but finishes in the background, so its translations still reach the cache
+def fetch_before(texts, source_language, dest_language, deadline):
+	if not texts:
+		return {}
+	app = current_app._get_current_object()
+	def run():
+		with app.app_context():
+			return fetch_translations(texts, source_language, dest_language, deadline)
+	start = monotonic()
+	future = translator_client.submit(run)
+	try:
+		return future.result(max(0, deadline - monotonic()))
+	except TimeoutError:
+		breaker.record(True, monotonic() - start)
+		current_app.logger.warning('Translation of %d texts ran past the %s second deadline', len(texts),
+			current_app.config['MS_TRANSLATOR_DEADLINE'])
+		return {}
+
+
+# what is shown for a translation that could not be fetched
+def failed_translation(text, source_language, dest_language):
+	if breaker.is_open():
+		return _('Error: the translation service is unavailable, please try again later.')
+	return text+' '+source_language+' '+dest_language
+	#return _('Error: the translation service failed.')
+
+
+# answered from translation_cache when possible, so a popular post is only sent upstream once per TTL
+def translate(text, source_language, dest_language):
+	return translate_many([text], source_language, dest_language)[0]
+
+
+# translations of texts that share a language pair, in the same order. only the distinct texts that are neither
+# cached nor already being fetched by another request are sent upstream, and the request waits for them until
+# deadline, by default MS_TRANSLATOR_DEADLINE seconds from now. a request translating several pairs passes the same
+# deadline to each call
+def translate_many(texts, source_language, dest_language, deadline=None):
+	if 'MS_TRANSLATOR_KEY' not in current_app.config or not current_app.config['MS_TRANSLATOR_KEY']:
+		return [_('Error: the translation service is not configured.')] * len(texts)
+	if deadline is None:
+		deadline = monotonic() + current_app.config['MS_TRANSLATOR_DEADLINE']
+	known = translation_cache.get_many(texts, source_language, dest_language)
+	missing = [text for text in dict.fromkeys(texts) if text not in known]
+	led, followed = [], []
+	for text in missing:
+		flight, leader = single_flight.begin((text, source_language, dest_language))
+		(led if leader else followed).append((text, flight))
+	fetched = {}
+	try:
+		fetched = fetch_before([text for text, flight in led], source_language, dest_language, deadline)
+	finally:
+		for text, flight in led:
+			single_flight.finish((text, source_language, dest_language), flight, fetched.get(text))
+	stragglers = []
+	for text, flight in followed:
+		done, translation = single_flight.wait(flight, deadline)
+		if not done:
+			stragglers.append(text)
+		elif translation is not None:
+			fetched[text] = translation
+	fetched.update(fetch_before(stragglers, source_language, dest_language, deadline))
+	for text in missing:
+		known[text] = fetched[text] if text in fetched else failed_translation(text, source_language, dest_language)
+	return [known[text] for text in texts]
@@ -0,0 +1,211 @@
+# the translation path on asyncio, so that a translation waiting on the translator holds a coroutine instead of a
+# worker thread. it shares the translation cache and the circuit breaker with app/translate.py and mirrors its
+# timeouts, retries, coalescing and deadline, with an httpx.AsyncClient in place of the requests session.
+#
+# Flask 2.0 runs an async view on an event loop of its own, inside the WSGI worker thread that took the request, so
+# /translate/async only shows the code path; it frees no threads. TranslationASGI below, served by an ASGI server
+# (see asgi.py), is what lets thousands of in-flight translations share one loop
+import asyncio
+import contextvars
+import json
+from time import monotonic
+from urllib.parse import parse_qs
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+from werkzeug.test import EnvironBuilder
+from flask import current_app
+from flask_babel import _
+from flask_login import current_user
+from app import db
+from app.last_seen import last_seen_buffer
+from app.translate import breaker, failed_translation, is_client_error, parse_translations, TranslatorClient
+from app.translation_cache import translation_cache
+
+
+# runs a blocking cache call on the loop's default thread pool, in the caller's app context
+async def run_sync(fn, *args):
+	def run():
+		try:
+			return fn(*args)
+		finally:
+			db.session.remove()
+	return await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, run)
+
+
+ssl_context = None
+
+
+class AsyncTranslator(object):
+	def __init__(self, config):
+		self.config = config
+		self.client = None
+		self.flights = {} # (text, source, dest) -> task fetching it, see SingleFlight in app/translate.py
+
+	# building the SSL context loads the CA bundle, which costs more than a translation, so every client shares one
+	def get_client(self):
+		global ssl_context
+		if self.client is None:
+			if ssl_context is None:
+				ssl_context = httpx.create_ssl_context()
+			size = self.config['MS_TRANSLATOR_ASYNC_POOL_SIZE']
+			self.client = httpx.AsyncClient(verify=ssl_context,
+				limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+				timeout=httpx.Timeout(self.config['MS_TRANSLATOR_READ_TIMEOUT'],
+					connect=self.config['MS_TRANSLATOR_CONNECT_TIMEOUT']),
+				headers={'Ocp-Apim-Subscription-Key': self.config['MS_TRANSLATOR_KEY'],
+					'Ocp-Apim-Subscription-Region': self.config['MS_TRANSLATOR_REGION']})
+		return self.client
+
+	async def aclose(self):
+		if self.client is not None:
+			await self.client.aclose()
+			self.client = None
+
+	# the same as request_translations in app/translate.py, with the retries and their backoff done here
+	async def request_translations(self, texts, source_language, dest_language, deadline):
+		if not breaker.allow():
+			return None
+		url = self.config['MS_TRANSLATOR_URL'] + '/translate?api-version=3.0&from={}&to={}'.format(
+			source_language, dest_language)
+		start = monotonic()
+		r = translations = None
+		try:
+			for attempt in range(self.config['MS_TRANSLATOR_RETRIES'] + 1):
+				if attempt > 1:
+					await asyncio.sleep(self.config['MS_TRANSLATOR_BACKOFF'] * 2 ** (attempt - 1))
+				try:
+					r = await self.get_client().post(url, json=[{'Text': text} for text in texts])
+				except httpx.HTTPError as e:
+					current_app.logger.warning('Translator request failed: %s', e)
+					r = None
+					continue
+				if r.status_code not in TranslatorClient.RETRY_STATUSES:
+					break
+			if r is not None and r.status_code == 200:
+				translations = parse_translations(r, len(texts))
+		finally:
+			if monotonic() <= deadline:
+				breaker.record(translations is None and not is_client_error(r), monotonic() - start)
+		return translations
+
+	async def fetch(self, text, source_language, dest_language, deadline):
+		translations = await self.request_translations([text], source_language, dest_language, deadline)
+		if translations is None:
+			return None
+		await run_sync(translation_cache.put, text, source_language, dest_language, translations[0])
+		return translations[0]
+
+	async def translate(self, text, source_language, dest_language):
+		if not self.config.get('MS_TRANSLATOR_KEY'):
+			return _('Error: the translation service is not configured.')
+		deadline = monotonic() + self.config['MS_TRANSLATOR_DEADLINE']
+		cached = await run_sync(translation_cache.get, text, source_language, dest_language)
+		if cached is not None:
+			return cached
+		key = (text, source_language, dest_language)
+		wait = self.config['MS_TRANSLATOR_COALESCE_WAIT']
+		flight = self.flights.get(key)
+		if flight is not None and wait > 0:
+			try:
+				translation = await asyncio.wait_for(asyncio.shield(flight), max(0, min(wait, deadline - monotonic())))
+				return translation or failed_translation(text, source_language, dest_language)
+			except asyncio.TimeoutError:
+				pass # the leader is stalled, call upstream ourselves
+		start = monotonic()
+		task = asyncio.ensure_future(self.fetch(text, source_language, dest_language, deadline))
+		if wait > 0 and key not in self.flights:
+			self.flights[key] = task
+			task.add_done_callback(lambda task: self.flights.pop(key, None) if self.flights.get(key) is task else None)
+		try:
+			# shielded, so that a call outliving the deadline still finishes and caches its translation
+			translation = await asyncio.wait_for(asyncio.shield(task), max(0, deadline - monotonic()))
+		except asyncio.TimeoutError:
+			breaker.record(True, monotonic() - start)
+			current_app.logger.warning('Translation ran past the %s second deadline', self.config['MS_TRANSLATOR_DEADLINE'])
+			translation = None
+		return translation or failed_translation(text, source_language, dest_language)
+
+
+# an ASGI application that answers POST /translate for logged in users on the event loop, with one long-lived
+# AsyncTranslator, and hands every other request to the Flask app through asgiref's WsgiToAsgi. a /translate without
+# a user in its session cookie goes to Flask too, which deals with remember-me cookies and redirects to the login page.
+# the user named by the cookie is loaded by Flask-Login, with its user_loader and session protection, so the cookie of
+# a user who has been deleted gets a 401
+class TranslationASGI(object):
+	def __init__(self, app):
+		self.app = app
+		self.wsgi = WsgiToAsgi(app)
+		self.translator = AsyncTranslator(app.config)
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] == 'lifespan':
+			return await self.lifespan(receive, send)
+		if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/translate' and \
+			self.session_user_id(scope) is not None:
+			if await self.authenticate(scope) is None:
+				return await self.respond(send, 401, {'error': 'not logged in'})
+			return await self.translate(receive, send)
+		return await self.wsgi(scope, receive, send)
+
+	async def lifespan(self, receive, send):
+		while True:
+			message = await receive()
+			if message['type'] == 'lifespan.startup':
+				await send({'type': 'lifespan.startup.complete'})
+			elif message['type'] == 'lifespan.shutdown':
+				await self.translator.aclose()
+				await send({'type': 'lifespan.shutdown.complete'})
+				return
+
+	# the user id in the Flask session cookie, or None
+	def session_user_id(self, scope):
+		cookies = parse_cookie(b'; '.join(value for name, value in scope['headers'] if name == b'cookie'))
+		value = cookies.get(self.app.session_cookie_name)
+		serializer = self.app.session_interface.get_signing_serializer(self.app)
+		if value is None or serializer is None:
+			return None
+		try:
+			session = serializer.loads(value, max_age=int(self.app.permanent_session_lifetime.total_seconds()))
+		except BadSignature:
+			return None
+		return session.get('_user_id')
+
+	# the id of the user Flask-Login finds logged in for this request's headers, or None. the visit is recorded in
+	# last_seen like a page view's. runs on the default thread pool, as the user_loader may query the database
+	async def authenticate(self, scope):
+		environ = EnvironBuilder(path=scope['path'], method=scope['method'],
+			headers=[(name.decode('latin1'), value.decode('latin1')) for name, value in scope['headers']],
+			environ_base={'REMOTE_ADDR': scope['client'][0]} if scope.get('client') else None).get_environ()
+		def load():
+			with self.app.request_context(environ):
+				if not current_user.is_authenticated:
+					return None
+				last_seen_buffer.record(current_user)
+				return current_user.id
+		return await asyncio.get_running_loop().run_in_executor(None, load)
+
+	async def translate(self, receive, send):
+		body = b''
+		while True:
+			message = await receive()
+			body += message.get('body', b'')
+			if not message.get('more_body'):
+				break
+		try:
+			form = {name: values[0] for name, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+		except UnicodeDecodeError:
+			return await self.respond(send, 400, {'error': 'the body is not valid UTF-8'})
+		if not all(name in form for name in ('text', 'source_language', 'dest_language')):
+			return await self.respond(send, 400, {'error': 'text, source_language and dest_language are required'})
+		with self.app.app_context():
+			text = await self.translator.translate(form['text'], form['source_language'], form['dest_language'])
+		await self.respond(send, 200, {'text': text})
+
+	@staticmethod
+	async def respond(send, status, payload):
+		body = json.dumps(payload).encode()
+		await send({'type': 'http.response.start', 'status': status, 'headers': [
+			(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+		await send({'type': 'http.response.body', 'body': body})
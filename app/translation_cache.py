@@ -0,0 +1,126 @@
+# two-tier cache for app.translate, keyed by (sha1 of the text, source language, dest language)
+# the first tier is an LRU in each process; the second is the translation_cache table, shared by every process and
+# surviving restarts. both tiers forget a translation TRANSLATION_CACHE_TTL seconds after it was fetched.
+# only successful translations are stored, so an upstream failure is retried on the next request
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import monotonic
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import CachedTranslation
+
+
+class TranslationCache(object):
+	def __init__(self, app=None):
+		self.memory = OrderedDict() # key -> (expires at, translation), least recently used first
+		self.lock = threading.Lock()
+		self.size = 0
+		self.ttl = 0
+		self.last_sweep = monotonic()
+		self.reset_stats()
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.size = app.config['TRANSLATION_CACHE_SIZE']
+		self.ttl = app.config['TRANSLATION_CACHE_TTL']
+		with self.lock:
+			self.memory.clear()
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.memory_hits = 0
+		self.table_hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(text, source, dest):
+		return hashlib.sha1(text.encode('utf-8')).hexdigest(), source, dest
+
+	def get(self, text, source, dest):
+		return self.get_many([text], source, dest).get(text)
+
+	# the cached translations of texts that share a language pair, as a dict that leaves out the misses. everything
+	# the first tier does not have is read from the table in one query
+	def get_many(self, texts, source, dest):
+		found, missing = {}, {}
+		now = monotonic()
+		with self.lock:
+			for text in set(texts):
+				key = self.key(text, source, dest)
+				entry = self.memory.get(key)
+				if entry is not None and entry[0] > now:
+					self.memory.move_to_end(key)
+					self.memory_hits += 1
+					found[text] = entry[1]
+				else:
+					missing[key[0]] = text
+		if missing:
+			cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+			rows = CachedTranslation.query.filter(CachedTranslation.text_hash.in_(list(missing)),
+				CachedTranslation.source == source, CachedTranslation.dest == dest,
+				CachedTranslation.created_at > cutoff).all()
+			for row in rows:
+				# promoted to the first tier for whatever is left of its time to live
+				age = (datetime.utcnow() - row.created_at).total_seconds()
+				self.remember(self.key(missing[row.text_hash], source, dest), row.translation, self.ttl - age)
+				found[missing[row.text_hash]] = row.translation
+			with self.lock:
+				self.table_hits += len(rows)
+				self.misses += len(missing) - len(rows)
+		return found
+
+	def remember(self, key, translation, ttl):
+		with self.lock:
+			self.memory[key] = (monotonic() + ttl, translation)
+			self.memory.move_to_end(key)
+			while len(self.memory) > self.size:
+				self.memory.popitem(last=False)
+
+	def put(self, text, source, dest, translation):
+		self.put_many({text: translation}, source, dest)
+
+	# stores a dict of text -> translation that share a language pair in one transaction, on a connection of its own,
+	# so that caching never commits or rolls back the caller's session
+	def put_many(self, translations, source, dest):
+		rows = []
+		for text, translation in translations.items():
+			key = self.key(text, source, dest)
+			self.remember(key, translation, self.ttl)
+			rows.append({'text_hash': key[0], 'source': source, 'dest': dest, 'translation': translation,
+				'created_at': datetime.utcnow()})
+		if not rows:
+			return
+		table = CachedTranslation.__table__
+		try:
+			with db.engine.begin() as connection:
+				# expired rows for the same keys
+				connection.execute(table.delete().where(table.c.text_hash.in_([row['text_hash'] for row in rows]) &
+					(table.c.source == source) & (table.c.dest == dest)))
+				connection.execute(table.insert(), rows)
+		except IntegrityError:
+			# another request stored one of them first; the rest are stored one by one
+			if len(rows) > 1:
+				for text, translation in translations.items():
+					self.put_many({text: translation}, source, dest)
+		if monotonic() - self.last_sweep > self.ttl / 10:
+			self.evict_expired()
+
+	# deletes every expired row from the table; returns how many there were
+	def evict_expired(self):
+		self.last_sweep = monotonic()
+		cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+		table = CachedTranslation.__table__
+		with db.engine.begin() as connection:
+			return connection.execute(table.delete().where(table.c.created_at < cutoff)).rowcount
+
+	def stats(self):
+		lookups = self.memory_hits + self.table_hits + self.misses
+		return {'memory_hits': self.memory_hits, 'table_hits': self.table_hits, 'misses': self.misses,
+			'hit_rate': (self.memory_hits + self.table_hits) / lookups if lookups else 0.0,
+			'memory_size': len(self.memory)}
+
+
+translation_cache = TranslationCache()
@@ -0,0 +1,79 @@
+# process-level cache in front of flask_login's user_loader
+# it holds detached, read-only snapshots of users (their column values only) in an LRU with a time to live.
+# a hit is merged into the request's session with load=False, which gives the request a live User without a SELECT.
+# every process has its own cache, so routes that change a user must invalidate it, and the TTL bounds how long
+# another process can keep serving an older snapshot
+import threading
+from collections import OrderedDict
+from time import monotonic
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+class UserCache(object):
+	def __init__(self, app=None):
+		self.entries = OrderedDict() # id -> (expires at, snapshot), least recently used first
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.size = 0
+		self.ttl = 0
+		if app is not None:
+			self.init_app(app)
+
+	def init_app(self, app):
+		self.size = app.config['USER_CACHE_SIZE']
+		self.ttl = app.config['USER_CACHE_TTL']
+		self.clear()
+
+	def get(self, id):
+		with self.lock:
+			entry = self.entries.get(id)
+			if entry is None or entry[0] < monotonic():
+				if entry is not None:
+					del self.entries[id]
+				self.misses += 1
+				return None
+			self.entries.move_to_end(id)
+			self.hits += 1
+			return entry[1]
+
+	def put(self, user):
+		if self.size <= 0:
+			return
+		snapshot = self.snapshot(user)
+		with self.lock:
+			self.entries[user.id] = (monotonic() + self.ttl, snapshot)
+			self.entries.move_to_end(user.id)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+
+	def invalidate(self, *ids):
+		with self.lock:
+			for id in ids:
+				self.entries.pop(id, None)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.hits = self.misses = self.evictions = 0
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+				'hit_rate': self.hits / lookups if lookups else 0.0}
+
+	# a copy of the user's column values that is not attached to any session, so that requests on other threads
+	# can merge it concurrently without ever sharing one instance
+	@staticmethod
+	def snapshot(user):
+		cls = type(user)
+		copy = cls(**{attr.key: getattr(user, attr.key) for attr in inspect(cls).column_attrs})
+		make_transient_to_detached(copy)
+		return copy
+
+
+user_cache = UserCache()
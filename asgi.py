@@ -0,0 +1,7 @@
+from app import create_app
+from app.translate_async import TranslationASGI
+
+# entry point for ASGI servers, e.g. uvicorn asgi:application
+# /translate is served on the event loop, everything else by the Flask app, see app/translate_async.py
+app = create_app()
+application = TranslationASGI(app)
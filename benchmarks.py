@@ -0,0 +1,655 @@
+# rough benchmarks for the hot paths of the app
+# run with: python benchmarks.py <benchmark> [options], e.g. python benchmarks.py timeline --users 100000 --posts 10000000
+# every benchmark builds its own throwaway sqlite database, so nothing here touches app.db
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+import time
+from time import perf_counter
+from app import create_app, db
+from app.models import User, Post, Timeline, followers
+from app.follow_graph import FollowGraph
+from app.language import LanguageDetector, NgramBackend
+from app.translate import translator_client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import Config
+
+
+class BenchConfig(Config):
+	TESTING = True
+	SQLALCHEMY_DATABASE_URI = None # set by main() to a database it removes afterwards
+	TEMPLATE_CACHE_DIR = None
+
+
+# times fn() repeat times and returns the median in milliseconds
+def timed(fn, repeat):
+	samples = []
+	for _ in range(repeat):
+		start = perf_counter()
+		fn()
+		samples.append((perf_counter() - start) * 1000)
+	return statistics.median(samples)
+
+
+# bulk-inserts users, follows and posts with core statements, because the ORM is far too slow at this scale
+def seed(users, posts, follows_per_user, chunk=50000):
+	db.session.execute(User.__table__.insert(), [
+		{'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i)}
+		for i in range(1, users + 1)])
+	for start in range(1, users + 1, chunk):
+		rows = set()
+		for follower in range(start, min(start + chunk, users + 1)):
+			for followed in random.sample(range(1, users + 1), min(follows_per_user, users - 1)):
+				if followed != follower:
+					rows.add((follower, followed))
+		if rows:
+			db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in rows])
+	epoch = datetime(2021, 1, 1)
+	for start in range(0, posts, chunk):
+		db.session.execute(Post.__table__.insert(), [
+			{'body': 'post {}'.format(i), 'user_id': random.randint(1, users),
+				'timestamp': epoch + timedelta(seconds=i), 'language': 'en'}
+			for i in range(start, min(start + chunk, posts))])
+	db.session.commit()
+
+
+# the UNION query followed_posts() used to run, kept here for comparison
+def union_query(user):
+	followed = Post.query.join(followers, followers.c.followed_id == Post.user_id).filter(
+		followers.c.follower_id == user.id)
+	return followed.union(Post.query.filter_by(user_id=user.id)).order_by(Post.timestamp.desc())
+
+
+def bench_timeline(args):
+	seed(args.users, args.posts, args.follows)
+	start = perf_counter()
+	Timeline.rebuild()
+	db.session.commit()
+	print('timeline rebuild: {:.0f} ms, {} rows'.format((perf_counter() - start) * 1000, Timeline.query.count()))
+	per_page = BenchConfig.POSTS_PER_PAGE
+	for user_id in random.sample(range(1, args.users + 1), args.samples):
+		user = User.query.get(user_id)
+		union = timed(lambda: union_query(user).limit(per_page).all(), args.repeat)
+		timeline = timed(lambda: user.timeline().limit(per_page).all(), args.repeat)
+		print('user {:>8}: union {:8.2f} ms, timeline {:8.2f} ms'.format(user_id, union, timeline))
+
+
+def bench_followed_posts(args):
+	seed(args.users, args.posts, 0)
+	per_page = BenchConfig.POSTS_PER_PAGE
+	for count in args.followees:
+		reader = User(username='reader{}'.format(count), email='reader{}@example.com'.format(count))
+		db.session.add(reader)
+		db.session.flush()
+		db.session.execute(followers.insert(), [{'follower_id': reader.id, 'followed_id': id}
+			for id in random.sample(range(1, args.users + 1), min(count, args.users))])
+		db.session.commit()
+		union = timed(lambda: union_query(reader).limit(per_page).all(), args.repeat)
+		single = timed(lambda: reader.followed_posts().limit(per_page).all(), args.repeat)
+		print('{:>6} followees: union {:8.2f} ms, single query {:8.2f} ms'.format(count, union, single))
+
+
+# short post-like texts, built from a few words per language
+WORDS = {
+	'en': 'the people who were walking along the river said that they would come back tomorrow morning with friends',
+	'es': 'la gente que caminaba por el río dijo que volvería mañana por la mañana con sus amigos y familia',
+	'fr': 'les gens qui marchaient le long de la rivière ont dit qu ils reviendraient demain matin avec des amis',
+	'de': 'die leute die am fluss entlang gingen sagten dass sie morgen früh mit ihren freunden wiederkommen würden',
+}
+
+
+def sample_posts(count, distinct):
+	rng = random.Random(0)
+	texts = []
+	for i in range(distinct):
+		language = list(WORDS)[i % len(WORDS)]
+		words = WORDS[language].split()
+		start = rng.randrange(len(words) - 8)
+		texts.append((language, ' '.join(words[start:start + rng.randint(6, 12)])))
+	return [texts[rng.randrange(distinct)] for _ in range(count)]
+
+
+def bench_language(args):
+	import langdetect
+	texts = [text for language, text in sample_posts(args.posts, args.distinct)]
+	def rate(fn):
+		start = perf_counter()
+		fn()
+		return len(texts) / (perf_counter() - start)
+	# everything loads its profiles before the clock starts
+	langdetect.detect(texts[0])
+	detector = LanguageDetector(cache_size=args.posts)
+	ngram = LanguageDetector(cache_size=args.posts, backend=NgramBackend(list(WORDS) + ['it', 'pt']))
+	detector.load()
+	ngram.load()
+	print('raw langdetect.detect:         {:8.0f} posts/s'.format(rate(lambda: [langdetect.detect(text) for text in texts])))
+	print('langdetect backend, detect:    {:8.0f} posts/s'.format(rate(lambda: [detector.detect(text) for text in texts])))
+	detector.memo.clear()
+	print('langdetect backend, batch:     {:8.0f} posts/s'.format(rate(lambda: detector.detect_many(texts))))
+	print('ngram backend, batch:          {:8.0f} posts/s'.format(rate(lambda: ngram.detect_many(texts))))
+	print('ngram backend, no memo:        {:8.0f} posts/s'.format(rate(lambda: ngram.backend.detect_many(texts))))
+	print('memoized batch:                {:8.0f} posts/s'.format(rate(lambda: detector.detect_many(texts))))
+	agreement = sum(a == b for a, b in zip(detector.detect_many(texts), ngram.detect_many(texts))) / len(texts)
+	print('ngram agrees with langdetect on {:.1%} of the posts'.format(agreement))
+
+
+def bench_follow_graph(args):
+	def edges():
+		for follower in range(1, args.users + 1):
+			for followed in sorted(random.sample(range(1, args.users + 1), args.follows)):
+				yield follower, followed
+	graph = FollowGraph()
+	start = perf_counter()
+	graph.build(edges())
+	print('built {} edges over {} users in {:.1f} s'.format(args.users * args.follows, args.users, perf_counter() - start))
+
+	size = sys.getsizeof(graph.following) + sys.getsizeof(graph.followed_by) + sum(
+		sys.getsizeof(ids) for lists in (graph.following, graph.followed_by) for ids in lists.values())
+	print('memory: {:.1f} MB, {:.1f} bytes per edge'.format(size / 2**20, size / (args.users * args.follows)))
+
+	pairs = [(random.randint(1, args.users), random.randint(1, args.users)) for _ in range(100000)]
+	start = perf_counter()
+	for a, b in pairs:
+		graph.is_following(a, b)
+	print('is_following: {:.2f} us per call'.format((perf_counter() - start) / len(pairs) * 1e6))
+	start = perf_counter()
+	for a, b in pairs[:10000]:
+		graph.mutuals(a, b)
+	print('mutuals: {:.2f} us per call'.format((perf_counter() - start) / 10000 * 1e6))
+
+
+# a keep-alive translator stub on a local port that answers every text after latency seconds and counts its requests
+def translator_stub(latency=0):
+	class Handler(BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+		disable_nagle_algorithm = True
+
+		def do_POST(self):
+			texts = [item['Text'] for item in json.loads(self.rfile.read(int(self.headers['Content-Length'])))]
+			server.requests += 1
+			if latency:
+				time.sleep(latency)
+			body = json.dumps([{'translations': [{'text': text}]} for text in texts]).encode()
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+	server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	server.requests = 0
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server, 'http://127.0.0.1:{}/translate?api-version=3.0&from=es&to=en'.format(server.server_port)
+
+
+def bench_translator_client(args):
+	import requests
+	server, url = translator_stub()
+	payload = [{'Text': 'Hola mundo'}]
+	# against localhost a new connection is only a TCP handshake; against the real service it also pays DNS and TLS
+	fresh = timed(lambda: requests.post(url, json=payload, timeout=10), args.calls)
+	pooled = timed(lambda: translator_client.post(url, json=payload), args.calls)
+	print('new connection per call: {:6.2f} ms'.format(fresh))
+	print('pooled session:          {:6.2f} ms'.format(pooled))
+	print('pool: {requests} requests over {connections} connections, reuse rate {reuse_rate:.1%}'.format(
+		**translator_client.stats()))
+	server.shutdown()
+
+
+# many concurrent /translate-like calls for a few popular texts, with and without single-flight coalescing
+def bench_translation_burst(args):
+	from flask import current_app
+	from app.models import CachedTranslation
+	from app.translation_cache import translation_cache
+	from app.translate import translate, single_flight
+	server, url = translator_stub(args.latency / 1000)
+	current_app.config['MS_TRANSLATOR_KEY'] = 'bench'
+	current_app.config['MS_TRANSLATOR_URL'] = url.split('/translate')[0]
+	texts = ['viral post {}'.format(i) for i in range(args.distinct)]
+	app = current_app._get_current_object()
+	for coalesce in (False, True):
+		translation_cache.memory.clear()
+		CachedTranslation.query.delete()
+		db.session.commit()
+		server.requests = 0
+		single_flight.timeout = 5 if coalesce else 0
+		single_flight.reset_stats()
+		barrier = threading.Barrier(args.requests)
+		def run(text):
+			with app.app_context():
+				barrier.wait()
+				translate(text, 'es', 'en')
+		threads = [threading.Thread(target=run, args=(texts[i % len(texts)],)) for i in range(args.requests)]
+		start = perf_counter()
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		print('coalescing {:3}: {} requests, {} upstream calls, collapse ratio {:.1f}, {:.0f} ms'.format(
+			'on' if coalesce else 'off', args.requests, server.requests, args.requests / server.requests,
+			(perf_counter() - start) * 1000))
+	server.shutdown()
+
+
+# concurrent translations of distinct texts through the sync view and the async view, both on a fixed pool of WSGI
+# worker threads, and through the ASGI app on one event loop with a connection for every translation in flight
+def bench_translation_load(args):
+	import asyncio
+	from concurrent.futures import ThreadPoolExecutor
+	import httpx
+	from flask import current_app
+	from app.translate_async import TranslationASGI
+	server, url = translator_stub(args.latency / 1000)
+	app = current_app._get_current_object()
+	app.config['MS_TRANSLATOR_KEY'] = 'bench'
+	app.config['MS_TRANSLATOR_URL'] = url.split('/translate')[0]
+	app.config['MS_TRANSLATOR_ASYNC_POOL_SIZE'] = args.requests
+	user = User(username='reader', email='reader@example.com')
+	db.session.add(user)
+	db.session.commit()
+	cookie = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(user.id), '_fresh': True})
+	def form(name, i):
+		return {'text': '{} {}'.format(name, i), 'source_language': 'es', 'dest_language': 'en'}
+	# the stub echoes texts back, so a translation that equals its text went through
+	def report(name, translated, seconds):
+		print('{:26} {:5} translations in {:6.0f} ms, {:7.1f} per second, {} translated'.format(
+			name, args.requests, seconds * 1000, args.requests / seconds, sum(translated)))
+
+	for name, path in (('sync view, {} threads'.format(args.threads), '/translate'),
+		('async view, {} threads'.format(args.threads), '/translate/async')):
+		clients = threading.local()
+		def post(i):
+			if not hasattr(clients, 'client'):
+				clients.client = app.test_client()
+				clients.client.set_cookie('localhost', app.session_cookie_name, cookie)
+			data = form(path, i)
+			return clients.client.post(path, data=data).get_json()['text'] == data['text']
+		start = perf_counter()
+		with ThreadPoolExecutor(args.threads) as pool:
+			translated = list(pool.map(post, range(args.requests)))
+		report(name, translated, perf_counter() - start)
+
+	async def run():
+		application = TranslationASGI(app)
+		async with httpx.AsyncClient(app=application, base_url='http://localhost') as client:
+			async def post(i):
+				data = form('asgi', i)
+				r = await client.post('/translate', data=data, cookies={app.session_cookie_name: cookie})
+				return r.json()['text'] == data['text']
+			translated = await asyncio.gather(*[post(i) for i in range(args.requests)])
+		await application.translator.aclose()
+		return translated
+	start = perf_counter()
+	translated = asyncio.run(run())
+	report('ASGI app, one event loop', translated, perf_counter() - start)
+	server.shutdown()
+
+
+# a minimal SMTP server that greets after connect_latency seconds, standing in for the handshakes of a real server,
+# and accepts and discards every message after latency seconds. it runs in a process of its own so its threads do
+# not count against the benchmark; returns the process, its port and a shared count of the messages
+def smtp_sink(latency=0, connect_latency=0):
+	import multiprocessing
+	received = multiprocessing.Value('i', 0)
+	ready = multiprocessing.Queue()
+	process = multiprocessing.Process(target=run_smtp_sink, args=(received, ready, latency, connect_latency),
+		daemon=True)
+	process.start()
+	return process, ready.get(), received
+
+
+def run_smtp_sink(received, ready, latency, connect_latency):
+	import socketserver
+	class Handler(socketserver.StreamRequestHandler):
+		def handle(self):
+			if connect_latency:
+				time.sleep(connect_latency)
+			self.wfile.write(b'220 sink ready\r\n')
+			for line in self.rfile:
+				command = line[:4].upper()
+				if command in (b'HELO', b'EHLO'):
+					self.wfile.write(b'250 sink\r\n')
+				elif command == b'DATA':
+					self.wfile.write(b'354 go ahead\r\n')
+					for data in self.rfile:
+						if data == b'.\r\n':
+							break
+					if latency:
+						time.sleep(latency)
+					with received.get_lock():
+						received.value += 1
+					self.wfile.write(b'250 queued\r\n')
+				elif command == b'QUIT':
+					self.wfile.write(b'221 bye\r\n')
+					return
+				else: # MAIL, RCPT, RSET, NOOP
+					self.wfile.write(b'250 ok\r\n')
+	socketserver.ThreadingTCPServer.daemon_threads = True
+	socketserver.ThreadingTCPServer.request_queue_size = 1024
+	server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+	ready.put(server.server_address[1])
+	server.serve_forever()
+
+
+# samples the thread count and resident memory of this process until stopped, keeping the peaks
+class PeakSampler(threading.Thread):
+	def __init__(self):
+		threading.Thread.__init__(self, daemon=True)
+		self.stopped = threading.Event()
+		self.threads = self.rss = 0
+
+	def run(self):
+		page = os.sysconf('SC_PAGE_SIZE')
+		while not self.stopped.wait(0.01):
+			self.threads = max(self.threads, threading.active_count())
+			with open('/proc/self/statm') as f:
+				self.rss = max(self.rss, int(f.read().split()[1]) * page)
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+
+# a burst of mail through the old thread-per-message send_email and through the outbox and its worker pool
+def bench_mail_burst(args):
+	from flask import current_app
+	from flask_mail import Message
+	from app import mail
+	from app.email import mail_dispatcher, send_email
+	process, port, received = smtp_sink(args.smtp_latency / 1000)
+	app = current_app._get_current_object()
+	app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port)
+	app.extensions['mail'].server, app.extensions['mail'].port = '127.0.0.1', port
+	app.extensions['mail'].suppress = False
+	def message(i):
+		return 'Password reset {}'.format(i), 'admin@example.com', ['user{}@example.com'.format(i)], 'text ' * 50, None
+	def wait_for(count):
+		while received.value < count:
+			time.sleep(0.01)
+
+	def old_send_email(subject, sender, recipients, text_body, html_body):
+		def send(msg):
+			with app.app_context():
+				mail.send(msg)
+		msg = Message(subject, sender=sender, recipients=recipients)
+		msg.body = text_body
+		msg.html = html_body
+		threading.Thread(target=send, args=(msg,)).start()
+
+	mail_dispatcher.workers = args.workers
+	for name, send in (('outbox, {} workers'.format(args.workers), send_email), ('thread per message', old_send_email)):
+		received.value = 0
+		sampler = PeakSampler()
+		sampler.start()
+		start = perf_counter()
+		for i in range(args.messages):
+			send(*message(i))
+		queued = perf_counter() - start
+		wait_for(args.messages)
+		elapsed = perf_counter() - start
+		sampler.stop()
+		print('{:20} queued in {:6.0f} ms, delivered in {:6.0f} ms ({:5.0f}/s), peak {:5} threads, peak RSS {:4.0f} MB'.format(
+			name, queued * 1000, elapsed * 1000, args.messages / elapsed, sampler.threads, sampler.rss / 2**20))
+		mail_dispatcher.stop()
+	process.terminate()
+
+
+# delivery rate of a queued backlog, with a new SMTP session per message and with each worker keeping one open
+def bench_mail_throughput(args):
+	from flask import current_app
+	from app.email import mail_dispatcher, send_email
+	process, port, received = smtp_sink(args.smtp_latency / 1000, args.connect_latency / 1000)
+	app = current_app._get_current_object()
+	app.extensions['mail'].server, app.extensions['mail'].port = '127.0.0.1', port
+	app.extensions['mail'].suppress = False
+	for workers in args.workers:
+		for reuse in (False, True):
+			mail_dispatcher.workers = 0 # queue the whole backlog before any worker starts
+			for i in range(args.messages):
+				send_email('Digest {}'.format(i), 'admin@example.com', ['user{}@example.com'.format(i)], 'text ' * 50, None)
+			received.value = 0
+			mail_dispatcher.workers, mail_dispatcher.reuse_connections = workers, reuse
+			start = perf_counter()
+			mail_dispatcher.start()
+			while received.value < args.messages:
+				time.sleep(0.005)
+			elapsed = perf_counter() - start
+			mail_dispatcher.stop()
+			print('{} workers, {:19} {:6.0f} messages/s'.format(workers,
+				'pooled sessions:' if reuse else 'session per message:', args.messages / elapsed))
+	process.terminate()
+
+
+# an error storm logged through the old SMTPHandler and through the queued digest handler, timing the logging call
+# that the failing request waits on
+def bench_error_storm(args):
+	import logging
+	from logging.handlers import SMTPHandler
+	from flask import current_app
+	from app.error_mail import error_mail_handler
+	process, port, received = smtp_sink(args.smtp_latency / 1000)
+	app = current_app._get_current_object()
+	app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, ERROR_MAIL_WINDOW=3600)
+	for name in ('SMTPHandler', 'queued digest'):
+		if name == 'SMTPHandler':
+			handler = SMTPHandler(mailhost=('127.0.0.1', port), fromaddr='no-reply@127.0.0.1',
+				toaddrs=app.config['ADMINS'], subject='Microblog Failure')
+			handler.setLevel(logging.ERROR)
+		else:
+			handler = error_mail_handler(app)
+		logger = logging.getLogger('bench.' + name)
+		logger.propagate = False
+		logger.addHandler(handler)
+		received.value = 0
+		samples = []
+		for i in range(args.errors):
+			start = perf_counter()
+			try:
+				1 / 0
+			except ZeroDivisionError:
+				logger.exception('Exception on /index [GET]')
+			samples.append((perf_counter() - start) * 1000)
+		logger.removeHandler(handler)
+		handler.close() # sends whatever the digest still holds
+		samples.sort()
+		print('{:14} per error: median {:7.3f} ms, p99 {:7.3f} ms, {:5} mails sent'.format(name,
+			statistics.median(samples), samples[int(len(samples) * 0.99)], received.value))
+	process.terminate()
+
+
+# requests that each log one line, with the old RotatingFileHandler on the request thread and with the queued file
+# handler of app/logs.py, timing the logging call inside the view, which is what logging adds to every request
+def bench_request_logging(args):
+	import logging
+	from logging.handlers import RotatingFileHandler
+	from flask import current_app
+	from flask.logging import default_handler
+	from app.logs import file_log_handler
+	app = current_app._get_current_object()
+	app.logger.removeHandler(default_handler) # the stderr handler Flask adds in debug mode
+	app.logger.setLevel(logging.INFO)
+	app.logger.propagate = False
+	samples = []
+	@app.route('/bench/logged')
+	def logged():
+		start = perf_counter()
+		app.logger.info('Served %s to %s', '/bench/logged', '127.0.0.1')
+		samples.append((perf_counter() - start) * 1e6)
+		return 'ok'
+	client = app.test_client()
+
+	def old_handler(directory):
+		handler = RotatingFileHandler(os.path.join(directory, 'microblog.log'), maxBytes=10240, backupCount=10)
+		handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+		handler.setLevel(logging.INFO)
+		return handler
+	def new_handler(format):
+		def build(directory):
+			app.config.update(LOG_FILE=os.path.join(directory, 'microblog.log'), LOG_FORMAT=format)
+			return file_log_handler(app)
+		return build
+	for name, build in (('RotatingFileHandler 10 KB', old_handler), ('queued, text', new_handler('text')),
+		('queued, json', new_handler('json'))):
+		directory = tempfile.mkdtemp()
+		handler = build(directory)
+		app.logger.addHandler(handler)
+		del samples[:]
+		start = perf_counter()
+		for i in range(args.requests):
+			client.get('/bench/logged')
+		elapsed = perf_counter() - start
+		app.logger.removeHandler(handler)
+		handler.close()
+		samples.sort()
+		print('{:26} logging per request: median {:5.1f} us, p99 {:6.1f} us, max {:7.1f} us; {:4.0f} requests/s, {:2} files'.format(
+			name, statistics.median(samples), samples[int(len(samples) * 0.99)], samples[-1], args.requests / elapsed,
+			len(os.listdir(directory))))
+
+# the first and a later request to each page on a fresh app, the way a new worker sees them, without the template cache,
+# with an empty one as after a deploy without flask templates precompile, and with a precompiled one
+def bench_template_cold_start(args):
+	from flask import current_app
+	from app import create_app
+	from app.template_cache import template_cache
+	seed(50, 2000, 10)
+	user = User.query.get(1)
+	user.set_password('cat')
+	db.session.commit()
+	config = current_app.config
+	pages = ['/login', '/index', '/explore', '/user/user2', '/edit_profile']
+
+	def fresh_app(cache_dir):
+		class ColdStartConfig(BenchConfig):
+			SQLALCHEMY_DATABASE_URI = config['SQLALCHEMY_DATABASE_URI']
+			WTF_CSRF_ENABLED = False
+			LANGUAGE_WORKERS = 0
+			MAIL_WORKERS = 0
+			TEMPLATE_CACHE_DIR = cache_dir
+		return create_app(ColdStartConfig)
+
+	def measure(app):
+		client = app.test_client()
+		first, later = [], []
+		for page in pages:
+			start = perf_counter()
+			client.get(page)
+			first.append((perf_counter() - start) * 1000)
+			if page == '/login':
+				client.post('/login', data={'username': 'user1', 'password': 'cat'})
+		for page in pages:
+			start = perf_counter()
+			client.get(page)
+			later.append((perf_counter() - start) * 1000)
+			if page == '/login':
+				client.post('/login', data={'username': 'user1', 'password': 'cat'})
+		return first, later
+
+	precompiled = tempfile.mkdtemp()
+	with fresh_app(precompiled).app_context():
+		template_cache.precompile(current_app)
+	for name, cache_dir in (('no template cache', lambda: None), ('empty cache', tempfile.mkdtemp),
+		('precompiled cache', lambda: precompiled)):
+		runs = [measure(fresh_app(cache_dir())) for _ in range(args.repeat)]
+		print('{}:'.format(name))
+		for i, page in enumerate(pages):
+			first = statistics.median(run[0][i] for run in runs)
+			later = statistics.median(run[1][i] for run in runs)
+			print('  {:14} first request {:6.2f} ms, later {:6.2f} ms'.format(page, first, later))
+		print('  {:14} first request {:6.2f} ms, later {:6.2f} ms'.format('all pages',
+			statistics.median(sum(run[0]) for run in runs), statistics.median(sum(run[1]) for run in runs)))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks for flask_practice.')
+	parser.add_argument('--repeat', type=int, default=20, help='runs per measurement')
+	subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+	timeline = subparsers.add_parser('timeline', help='home page: UNION followed_posts() vs materialized timeline')
+	timeline.add_argument('--users', type=int, default=2000)
+	timeline.add_argument('--posts', type=int, default=50000)
+	timeline.add_argument('--follows', type=int, default=20, help='users followed by each user')
+	timeline.add_argument('--samples', type=int, default=5, help='users whose home page is timed')
+	timeline.set_defaults(run=bench_timeline)
+
+	followed_posts = subparsers.add_parser('followed-posts', help='first page of followed_posts() by number of followees')
+	followed_posts.add_argument('--users', type=int, default=10000)
+	followed_posts.add_argument('--posts', type=int, default=1000000)
+	followed_posts.add_argument('--followees', type=int, nargs='+', default=[1, 10, 100, 1000, 5000])
+	followed_posts.set_defaults(run=bench_followed_posts)
+
+	language = subparsers.add_parser('language', help='language detection throughput, raw langdetect vs the memoized service')
+	language.add_argument('--posts', type=int, default=5000)
+	language.add_argument('--distinct', type=int, default=1000, help='distinct texts among the posts')
+	language.set_defaults(run=bench_language)
+
+	follow_graph = subparsers.add_parser('follow-graph', help='memory and lookup speed of the in-process follow graph')
+	follow_graph.add_argument('--users', type=int, default=100000)
+	follow_graph.add_argument('--follows', type=int, default=100, help='users followed by each user')
+	follow_graph.set_defaults(run=bench_follow_graph)
+
+	translator = subparsers.add_parser('translator-client', help='translator calls, new connection each vs the pooled client')
+	translator.add_argument('--calls', type=int, default=500)
+	translator.set_defaults(run=bench_translator_client)
+
+	burst = subparsers.add_parser('translation-burst', help='concurrent identical translations, with and without coalescing')
+	burst.add_argument('--requests', type=int, default=200, help='concurrent translations')
+	burst.add_argument('--distinct', type=int, default=5, help='distinct texts among them')
+	burst.add_argument('--latency', type=float, default=100, help='milliseconds the stub takes to answer')
+	burst.set_defaults(run=bench_translation_burst)
+
+	load = subparsers.add_parser('translation-load', help='concurrent translations, sync and async views vs the ASGI app')
+	load.add_argument('--requests', type=int, default=1000, help='distinct translations in flight at once')
+	load.add_argument('--threads', type=int, default=16, help='WSGI worker threads for the views')
+	load.add_argument('--latency', type=float, default=100, help='milliseconds the stub takes to answer')
+	load.set_defaults(run=bench_translation_load)
+
+	mail_burst = subparsers.add_parser('mail-burst', help='a burst of mail, thread per message vs the outbox worker pool')
+	mail_burst.add_argument('--messages', type=int, default=10000)
+	mail_burst.add_argument('--workers', type=int, default=8, help='outbox worker threads')
+	mail_burst.add_argument('--smtp-latency', type=float, default=20, help='milliseconds the sink takes per message')
+	mail_burst.set_defaults(run=bench_mail_burst)
+
+	mail_throughput = subparsers.add_parser('mail-throughput', help='mail delivery rate, SMTP session per message vs pooled')
+	mail_throughput.add_argument('--messages', type=int, default=2000)
+	mail_throughput.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+	mail_throughput.add_argument('--smtp-latency', type=float, default=0, help='milliseconds the sink takes per message')
+	mail_throughput.add_argument('--connect-latency', type=float, default=20,
+		help='milliseconds before the sink greets a new session, standing in for TCP, TLS and login')
+	mail_throughput.set_defaults(run=bench_mail_throughput)
+
+	error_storm = subparsers.add_parser('error-storm', help='logging a burst of errors, SMTPHandler vs the queued digest')
+	error_storm.add_argument('--errors', type=int, default=500)
+	error_storm.add_argument('--smtp-latency', type=float, default=50, help='milliseconds the sink takes per message')
+	error_storm.set_defaults(run=bench_error_storm)
+
+	request_logging = subparsers.add_parser('request-logging', help='per-request cost of the log file, old vs queued')
+	request_logging.add_argument('--requests', type=int, default=20000)
+	request_logging.set_defaults(run=bench_request_logging)
+
+	templates = subparsers.add_parser('template-cold-start', help='first requests on a fresh app, with and without precompiled templates')
+	templates.set_defaults(run=bench_template_cold_start)
+
+	args = parser.parse_args()
+	directory = tempfile.mkdtemp()
+	try:
+		app = create_app(BenchConfig)
+		app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+		with app.app_context():
+			db.create_all()
+			args.run(args)
+			db.session.remove()
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+	main()
@@ -20,9 +20,57 @@ class Config(object):
 	MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
 	MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
 	MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+	# errors with the same exception type and location are mailed to ADMINS as one summary, see app/error_mail.py
+	ERROR_MAIL_WINDOW = 60 # seconds errors are grouped for before the summaries go out
+
+	# outgoing mail goes through the mail_outbox table, see app/email.py
+	MAIL_WORKERS = 2 # sender threads per process, 0 leaves the mail for flask mail drain
+	MAIL_BATCH_SIZE = 50 # messages a worker claims at a time
+	MAIL_MAX_ATTEMPTS = 5 # attempts before a message is marked dead
+	MAIL_RETRY_BACKOFF = 60 # seconds before the first retry, doubled for each one after it
+	MAIL_POLL_INTERVAL = 10 # seconds an idle worker waits before looking for due mail again
+	MAIL_CLAIM_TIMEOUT = 300 # seconds after which mail claimed by a worker that died is sent again
+	MAIL_REUSE_CONNECTIONS = True # each worker sends over one SMTP session while it has mail, instead of one per message
+	MAIL_MAX_EMAILS = 100 # messages over one session before Flask-Mail reconnects
+
+	# the log file, written off the request thread, see app/logs.py
+	LOG_FILE = os.environ.get('LOG_FILE') or os.path.join('logs', 'microblog.log')
+	LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text' # or 'json', one object per line
+	LOG_ROTATION = os.environ.get('LOG_ROTATION') or 'size' # or 'time'
+	LOG_MAX_BYTES = 10 * 1024 * 1024 # size the file rolls over at with 'size'
+	LOG_ROTATE_WHEN = 'midnight' # TimedRotatingFileHandler's when and interval, used with 'time'
+	LOG_ROTATE_INTERVAL = 1
+	LOG_BACKUP_COUNT = 10 # rolled files kept
+	LOG_COMPRESS = True # gzip rolled files
+
+	# compiled templates shared by the workers, see app/template_cache.py; filled with flask templates precompile
+	TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or os.path.join(basedir, 'template_cache')
 
 	POSTS_PER_PAGE = 20
 
+	# User.last_seen is buffered in memory and written in bulk, see app/last_seen.py
+	LAST_SEEN_FLUSH_INTERVAL = 30 # seconds between bulk writes
+	LAST_SEEN_BUFFER_SIZE = 1000 # users waiting in the buffer before an early write
+	LAST_SEEN_TOLERANCE = 60 # seconds a stored last_seen may lag behind before a visit is recorded again
+	LAST_SEEN_FLUSHER = True # a daemon thread writes the buffer, False leaves the writes to the requests
+
+	# snapshots of logged in users kept in front of the user_loader, see app/user_cache.py
+	USER_CACHE_SIZE = 10000
+	USER_CACHE_TTL = 60 # seconds
+
+	# background language detection of new posts, see app/language.py
+	LANGUAGE_WORKERS = 1 # threads, 0 leaves new posts for flask posts detect-languages
+	LANGUAGE_SWEEP = True # detect the posts a previous run left without a language, False leaves them to the cli
+	LANGUAGE_CHUNK_SIZE = 500 # posts a sweep claims at a time
+	LANGUAGE_SWEEP_LEASE = 300 # seconds after which posts claimed by a sweep that died are claimed again
+	LANGUAGE_CACHE_SIZE = 10000 # detected texts remembered per process
+	# 'langdetect', or 'ngram' for the numpy classifier that only tells apart LANGUAGES and the extra languages below
+	LANGUAGE_DETECTOR = os.environ.get('LANGUAGE_DETECTOR') or 'langdetect'
+	LANGUAGE_DETECTOR_EXTRA_LANGUAGES = ['fr', 'de', 'it', 'pt']
+
+	# keep the whole follow graph in memory, see app/follow_graph.py
+	FOLLOW_GRAPH_ENABLED = os.environ.get('FOLLOW_GRAPH_ENABLED') is not None
+
 	TOKEN_EXPIRATION = 600
 
 	ADMINS = ['flask_practice@flask_pratice.com']
@@ -30,3 +78,27 @@ class Config(object):
 
 	MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
 	MS_TRANSLATOR_REGION = 'koreacentral'
+	MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or 'https://api.cognitive.microsofttranslator.com'
+	MS_TRANSLATOR_BATCH_SIZE = 100 # texts per request to the translator, at most 100
+	MS_TRANSLATOR_BATCH_MAX = 100 # posts one request to /translate/batch may ask for
+	# the pooled client used for every call to the translator, see TranslatorClient in app/translate.py
+	MS_TRANSLATOR_POOL_SIZE = 10 # keep-alive connections per process
+	MS_TRANSLATOR_CONNECT_TIMEOUT = 3.05 # seconds
+	MS_TRANSLATOR_READ_TIMEOUT = 10 # seconds
+	MS_TRANSLATOR_RETRIES = 2 # extra attempts after a connection error, timeout or 429/5xx answer
+	MS_TRANSLATOR_BACKOFF = 0.5 # urllib3's backoff factor, retries wait 0, 2, 4, ... times this many seconds
+	MS_TRANSLATOR_ASYNC_POOL_SIZE = 100 # connections shared by the event loop of the ASGI app, see asgi.py
+	# concurrent requests for the same translation share one upstream call, see SingleFlight in app/translate.py
+	MS_TRANSLATOR_COALESCE_WAIT = 5 # seconds a request waits on the one it shares before calling itself, 0 is off
+	# time a request may spend waiting on the translator, whatever the timeouts and retries above add up to
+	MS_TRANSLATOR_DEADLINE = 5 # seconds
+	# fail fast while the translator is down or slow, see CircuitBreaker in app/translate.py
+	MS_TRANSLATOR_BREAKER_WINDOW = 60 # seconds of calls the error rate is taken over
+	MS_TRANSLATOR_BREAKER_MIN_CALLS = 10 # calls in the window before it can trip
+	MS_TRANSLATOR_BREAKER_ERROR_RATE = 0.5 # share of failed calls that trips it
+	MS_TRANSLATOR_BREAKER_SLOW_CALL = 3 # seconds after which a call counts as failed
+	MS_TRANSLATOR_BREAKER_COOLDOWN = 30 # seconds open before a trial call
+
+	# translations kept in memory and in the translation_cache table, see app/translation_cache.py
+	TRANSLATION_CACHE_SIZE = 10000 # translations remembered per process
+	TRANSLATION_CACHE_TTL = 7 * 24 * 3600 # seconds
@@ -1,5 +1,5 @@
 from app import create_app, db, cli
-from app.models import User, Post
+from app.models import User, Post, Timeline
 
 app = create_app()
 cli.register(app)
@@ -9,4 +9,4 @@ cli.register(app)
 def make_shell_context():
 	# shell automatically imports app
 	# set so that we don't have to import in shell
-    return {'db': db, 'User': User, 'Post': Post}
+    return {'db': db, 'User': User, 'Post': Post, 'Timeline': Timeline}
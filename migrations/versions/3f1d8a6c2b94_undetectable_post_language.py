@@ -0,0 +1,28 @@
+"""mark posts of undetectable language
+
+Revision ID: 3f1d8a6c2b94
+Revises: 9c3e51d7a2b8
+Create Date: 2021-08-02 09:47:12.408316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1d8a6c2b94'
+down_revision = '9c3e51d7a2b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # '' was written both for posts nothing could be detected in and for posts that failed to detect, so they get one
+    # more pass of flask posts detect-languages, which marks the ones that are still undetectable with 'und'
+    post = sa.table('post', sa.column('language'))
+    op.execute(post.update().where(post.c.language == '').values(language=None))
+
+
+def downgrade():
+    post = sa.table('post', sa.column('language'))
+    op.execute(post.update().where(post.c.language == 'und').values(language=''))
@@ -0,0 +1,53 @@
+"""primary key and reverse index on followers
+
+Revision ID: 475841594cc0
+Revises: 75b5ad0c4740
+Create Date: 2021-07-23 11:26:09.640718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '475841594cc0'
+down_revision = '75b5ad0c4740'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the old table allowed duplicate and half-empty rows, so copy the distinct complete pairs into a keyed table
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+
+    # duplicates were counted when the counters were backfilled, recount them now that they are gone
+    user = sa.table('user', sa.column('id'), sa.column('followers_count'), sa.column('following_count'))
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    op.execute(user.update().values(
+        followers_count=sa.select(sa.func.count()).where(followers.c.followed_id == user.c.id).scalar_subquery(),
+        following_count=sa.select(sa.func.count()).where(followers.c.follower_id == user.c.id).scalar_subquery()))
+
+
+def downgrade():
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
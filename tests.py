@@ -1,12 +1,52 @@
+import asyncio
 from datetime import datetime, timedelta
+import gzip
+import json
+import logging
+import os
+import shutil
+import smtplib
+import sqlite3
+import tempfile
+import threading
+import time
+from logging.handlers import TimedRotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import unittest
-from app import flask_app, db
-from app.models import User, Post
+from unittest import mock
+import httpx
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import create_app, db, mail, cli
+from app.models import User, Post, Timeline, CachedTranslation, OutgoingMail, followers
+from app.pagination import paginate
+from app.last_seen import last_seen_buffer
+from app.user_cache import user_cache
+from app.follow_graph import follow_graph
+from app.language import backfill_languages, language_detector, language_worker, LangdetectBackend, NgramBackend
+from app.translate import translate, translator_client, single_flight, breaker
+from app.translation_cache import translation_cache
+from app.translate_async import TranslationASGI
+from app.email import mail_dispatcher, send_email
+from app.error_mail import error_mail_handler
+from app.logs import file_log_handler
+from app.template_cache import template_cache, not_hidden
 from config import Config
 
 class TestConfig(Config):
 	TESTING = True
 	SQLALCHEMY_DATABASE_URI = 'sqlite://'
+	WTF_CSRF_ENABLED = False
+	LANGUAGE_WORKERS = 0
+	MAIL_WORKERS = 0
+	TEMPLATE_CACHE_DIR = None
+	LAST_SEEN_FLUSHER = False
+
+# sqlite's EXPLAIN QUERY PLAN for a query, as one string
+def query_plan(query):
+	statement = query.statement if hasattr(query, 'statement') else query
+	sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+	return ' / '.join(row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql))
 
 class UserModelCase(unittest.TestCase):
 	def setUp(self):
@@ -43,12 +83,167 @@ class UserModelCase(unittest.TestCase):
 		self.assertEqual(u1.followed.first().username, 'susan')
 		self.assertEqual(u2.followers.count(), 1)
 		self.assertEqual(u2.followers.first().username, 'john')
+		self.assertEqual((u1.following_count, u1.followers_count), (1, 0))
+		self.assertEqual((u2.following_count, u2.followers_count), (0, 1))
+
+		# following twice does not count twice
+		u1.follow(u2)
+		db.session.commit()
+		self.assertEqual(u2.followers_count, 1)
 
 		u1.unfollow(u2)
 		db.session.commit()
 		self.assertFalse(u1.is_following(u2))
 		self.assertEqual(u1.followed.count(), 0)
 		self.assertEqual(u2.followers.count(), 0)
+		self.assertEqual((u1.following_count, u2.followers_count), (0, 0))
+
+	def test_followers_indexes(self):
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+
+		# the composite primary key serves is_following, follow/unfollow and the followed relationship,
+		# the reverse index serves the followers backref; none of them scans the table
+		plans = [
+			query_plan(db.session.query(u1.following_clause(u2))),
+			query_plan(followers.delete().where((followers.c.follower_id == u1.id) & (followers.c.followed_id == u2.id))),
+			query_plan(u1.followed),
+			query_plan(u1.followed_posts()),
+		]
+		for plan in plans:
+			self.assertIn('sqlite_autoindex_followers_1', plan)
+			self.assertNotIn('SCAN followers', plan)
+		plan = query_plan(u2.followers)
+		self.assertIn('ix_followers_followed_id_follower_id', plan)
+		self.assertNotIn('SCAN followers', plan)
+
+		# a repeated follow is absorbed by the INSERT itself and never creates a duplicate row
+		u1.follow(u2)
+		u1.follow(u2)
+		db.session.commit()
+		self.assertEqual(db.session.query(followers).count(), 1)
+		self.assertEqual((u1.following_count, u2.followers_count), (1, 1))
+		# even when the row appears after the check, as when another request follows at the same time
+		with mock.patch.object(User, 'following_clause', return_value=db.false()):
+			u1.follow(u2)
+		db.session.commit()
+		self.assertEqual((u1.following_count, u2.followers_count), (1, 1))
+
+	def test_follow_graph(self):
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		u3 = User(username='mary', email='mary@example.com')
+		db.session.add_all([u1, u2, u3])
+		db.session.commit()
+		u1.follow(u3)
+		db.session.commit()
+
+		# loaded from the followers table on first use
+		follow_graph.enabled = True
+		self.assertTrue(u1.is_following(u3))
+		self.assertFalse(u3.is_following(u1))
+
+		# later changes are applied when they commit, and dropped when they roll back
+		u1.follow(u2)
+		u2.follow(u3)
+		db.session.commit()
+		u3.follow(u1)
+		db.session.rollback()
+		self.assertEqual(follow_graph.followees(u1.id), (u2.id, u3.id)) # a copy the caller cannot change
+		self.assertEqual(list(follow_graph.followers(u3.id)), [u1.id, u2.id])
+		self.assertEqual(follow_graph.mutuals(u1.id, u2.id), (u3.id,))
+		self.assertFalse(u3.is_following(u1))
+
+		u1.unfollow(u3)
+		db.session.commit()
+		self.assertFalse(u1.is_following(u3))
+		self.assertEqual(list(follow_graph.followers(u3.id)), [u2.id])
+
+	def test_follow_graph_loaded_once(self):
+		def reload():
+			time.sleep(0.05)
+			follow_graph.build([])
+		with mock.patch.object(follow_graph, 'reload', side_effect=reload) as load:
+			threads = [threading.Thread(target=follow_graph.ensure_loaded) for i in range(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+		self.assertEqual(load.call_count, 1)
+
+	def test_followed_posts_of_many_followees(self):
+		u = User(username='john', email='john@example.com')
+		others = [User(username='user{}'.format(i), email='user{}@example.com'.format(i)) for i in range(20)]
+		db.session.add_all([u] + others)
+		db.session.commit()
+		for other in others:
+			u.follow(other)
+			other.add_post('post from {}'.format(other.username), 'en')
+		db.session.commit()
+		follow_graph.enabled = True
+		# fewer bound parameters than followees, so the followee ids must not be bound one by one
+		db.engine.raw_connection().connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 10)
+		self.assertEqual(len(u.followed_posts().all()), 20)
+
+	def test_backfill_languages(self):
+		u = User(username='john', email='john@example.com')
+		db.session.add(u)
+		db.session.commit()
+		english = u.add_post('The quick brown fox jumps over the lazy dog near the river bank', 'xx')
+		spanish = u.add_post('El rápido zorro marrón salta sobre el perro perezoso cerca del río', 'xx')
+		digits = u.add_post('12345', 'xx')
+		done = u.add_post('Bonjour tout le monde', 'fr')
+		Post.query.filter_by(language='xx').update({'language': None}) # old rows from before detection
+		db.session.commit()
+
+		seen = []
+		self.assertEqual(backfill_languages(chunk_size=2, workers=1, progress=lambda n, last: seen.append(n)), 3)
+		self.assertEqual(seen, [2, 3])
+		self.assertEqual([p.language for p in (english, spanish, digits, done)], ['en', 'es', Post.UNDETECTABLE, 'fr'])
+		# the post of no detectable language is not tried again
+		with mock.patch.object(language_detector, 'run', side_effect=AssertionError('detected again')):
+			self.assertEqual(backfill_languages(workers=1), 0)
+
+		# nothing left for the template to detect
+		with mock.patch.object(language_detector, 'run', side_effect=AssertionError('langdetect called while rendering')):
+			self.assertEqual([p.get_language() for p in (english, spanish, digits, done)], ['en', 'es', '', 'fr'])
+
+	def test_language_detector(self):
+		texts = ['This is definitely a sentence written in English', 'hola', 'hola', '!!!']
+		# the same short text always gets the same answer, even without the memo
+		answers = set(LangdetectBackend().detect_many(['hola'] * 20))
+		self.assertEqual(len(answers), 1)
+
+		language_detector.memo.clear()
+		with mock.patch.object(language_detector, 'run', wraps=language_detector.run) as run:
+			languages = language_detector.detect_many(texts)
+			run.assert_called_once_with(['This is definitely a sentence written in English', 'hola', '!!!'])
+			self.assertEqual(languages, ['en', answers.pop(), languages[1], ''])
+			self.assertEqual(language_detector.detect(texts[0]), 'en')
+			self.assertEqual(run.call_count, 1) # answered from the memo
+
+	def test_reconcile_counters(self):
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+		u1.follow(u2)
+		u2.add_post('post from susan', 'en')
+		u2.add_post('another post from susan', 'en')
+		db.session.commit()
+		self.assertEqual(u2.posts_count, 2)
+		self.assertEqual(User.reconcile_counters(), 0)
+
+		# counters that drifted are repaired in bulk, the others are left alone
+		u2.followers_count = 7
+		u2.posts_count = 0
+		db.session.commit()
+		self.assertEqual(User.reconcile_counters(), 1)
+		db.session.commit()
+		self.assertEqual((u2.followers_count, u2.posts_count), (1, 2))
+		self.assertEqual((u1.following_count, u1.posts_count), (1, 0))
 
 	def test_follow_posts(self):
 		# create four users
@@ -88,5 +283,944 @@ class UserModelCase(unittest.TestCase):
 		self.assertEqual(f3, [p3, p4])
 		self.assertEqual(f4, [p4])
 
+	def test_timeline(self):
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		u3 = User(username='mary', email='mary@example.com')
+		db.session.add_all([u1, u2, u3])
+		db.session.commit()
+
+		# posts written before the follow are backfilled, later posts are fanned out
+		p1 = u2.add_post('post from susan', 'en')
+		db.session.commit()
+		u1.follow(u2)
+		u1.follow(u3)
+		db.session.commit()
+		p2 = u3.add_post('post from mary', 'en')
+		p3 = u1.add_post('post from john', 'en')
+		db.session.commit()
+		self.assertEqual(u1.timeline().all(), u1.followed_posts().all())
+		self.assertEqual(set(u1.timeline().all()), {p1, p2, p3})
+		self.assertEqual(u2.timeline().all(), [p1])
+
+		# unfollowing trims the followed user's posts back out
+		u1.unfollow(u2)
+		db.session.commit()
+		self.assertEqual(set(u1.timeline().all()), {p2, p3})
+
+		# a rebuild from scratch gives the same timelines
+		Timeline.rebuild()
+		db.session.commit()
+		self.assertEqual(set(u1.timeline().all()), {p2, p3})
+		self.assertEqual(u3.timeline().all(), [p2])
+
+	def test_keyset_pagination(self):
+		u = User(username='john', email='john@example.com')
+		db.session.add(u)
+		now = datetime.utcnow()
+		# two posts share a timestamp, so the id has to break the tie
+		posts = [Post(body=str(i), author=u, timestamp=now + timedelta(seconds=min(i, 5))) for i in range(7)]
+		db.session.add_all(posts)
+		db.session.commit()
+		newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+		page1 = paginate(Post.query, Post.timestamp, Post.id, 3)
+		self.assertEqual(page1.items, newest_first[0:3])
+		self.assertTrue(page1.has_next)
+		self.assertFalse(page1.has_prev)
+		page2 = paginate(Post.query, Post.timestamp, Post.id, 3, before=page1.next_cursor)
+		self.assertEqual(page2.items, newest_first[3:6])
+		page3 = paginate(Post.query, Post.timestamp, Post.id, 3, before=page2.next_cursor)
+		self.assertEqual(page3.items, newest_first[6:])
+		self.assertFalse(page3.has_next)
+		self.assertTrue(page3.has_prev)
+
+		# walking back towards newer posts
+		back = paginate(Post.query, Post.timestamp, Post.id, 3, after=page3.prev_cursor)
+		self.assertEqual(back.items, page2.items)
+		back = paginate(Post.query, Post.timestamp, Post.id, 3, after=back.prev_cursor)
+		self.assertEqual(back.items, page1.items)
+		self.assertFalse(back.has_prev)
+
+		# a garbled cursor falls back to the first page
+		self.assertEqual(paginate(Post.query, Post.timestamp, Post.id, 3, before='garbage!').items, page1.items)
+
+	def test_profile_pagination(self):
+		u1 = User(username='john', email='john@example.com')
+		u2 = User(username='susan', email='susan@example.com')
+		db.session.add_all([u1, u2])
+		db.session.commit()
+		for i in range(5):
+			u1.add_post('john {}'.format(i), 'en')
+			u2.add_post('susan {}'.format(i), 'en')
+		db.session.commit()
+
+		page = paginate(u1.posts, Post.timestamp, Post.id, 3)
+		self.assertEqual([p.body for p in page.items], ['john 4', 'john 3', 'john 2'])
+		page = paginate(u1.posts, Post.timestamp, Post.id, 3, before=page.next_cursor)
+		self.assertEqual([p.body for p in page.items], ['john 1', 'john 0'])
+		self.assertFalse(page.has_next)
+
+		# the page is a range scan of the (user_id, timestamp) index, not a scan and sort of every post
+		cursor = db.tuple_(Post.timestamp, Post.id) < (datetime.utcnow(), 100)
+		plan = query_plan(u1.posts.filter(cursor).order_by(Post.timestamp.desc(), Post.id.desc()).limit(4))
+		self.assertIn('ix_post_user_id_timestamp', plan)
+		self.assertNotIn('TEMP B-TREE', plan)
+
+class PageRenderCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(TestConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.client = self.app.test_client()
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def login(self, username, password='cat'):
+		return self.client.post('/login', data={'username': username, 'password': password})
+
+	# SQL statements issued while fetching url
+	def queries(self, url):
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			statements.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			self.assertEqual(self.client.get(url).status_code, 200)
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+		return statements
+
+	def count_queries(self, url):
+		return len(self.queries(url))
+
+	def test_post_authors_are_eager_loaded(self):
+		reader = User(username='reader', email='reader@example.com')
+		reader.set_password('cat')
+		authors = [User(username='author{}'.format(i), email='author{}@example.com'.format(i)) for i in range(20)]
+		db.session.add_all([reader] + authors)
+		db.session.commit()
+		for author in authors:
+			reader.follow(author)
+			author.add_post('post from {}'.format(author.username), 'en')
+		db.session.commit()
+		self.login('reader')
+
+		# the number of queries must not depend on how many posts (and distinct authors) are on the page
+		counts = {}
+		for per_page in (5, 20):
+			self.app.config['POSTS_PER_PAGE'] = per_page
+			counts[per_page] = {url: self.count_queries(url) for url in ('/index', '/explore', '/user/author3')}
+		self.assertEqual(counts[5], counts[20])
+
+	def test_read_only_page_views_do_not_write(self):
+		u = User(username='john', email='john@example.com', last_seen=datetime.utcnow() - timedelta(hours=1))
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.login('john')
+
+		writes = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			if not statement.lstrip().upper().startswith('SELECT'):
+				writes.append(statement)
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			for url in ('/index', '/explore', '/user/john'):
+				self.assertEqual(self.client.get(url).status_code, 200)
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+		self.assertEqual(writes, [])
+
+		# the visits were coalesced into one pending time, written by a single bulk UPDATE
+		self.assertEqual(list(last_seen_buffer.pending), [u.id])
+		self.assertEqual(last_seen_buffer.flush(), 1)
+		db.session.expire_all()
+		self.assertLess(datetime.utcnow() - User.query.get(u.id).last_seen, timedelta(minutes=1))
+
+	def test_last_seen_buffer_flushes_when_full(self):
+		users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i), last_seen=datetime(2021, 1, 1))
+			for i in range(3)]
+		db.session.add_all(users)
+		db.session.commit()
+		last_seen_buffer.buffer_size = 3
+		now = datetime.utcnow()
+		last_seen_buffer.record(users[0], now)
+		last_seen_buffer.record(users[1], now)
+		self.assertEqual(len(last_seen_buffer.pending), 2)
+		last_seen_buffer.record(users[2], now)
+		self.assertEqual(last_seen_buffer.pending, {})
+		db.session.expire_all()
+		self.assertEqual([u.last_seen for u in User.query.order_by(User.id)], [now] * 3)
+
+	def test_failed_last_seen_flush_does_not_fail_the_page(self):
+		u = User(username='john', email='john@example.com', last_seen=datetime(2021, 1, 1))
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.login('john')
+		last_seen_buffer.flush_interval = 0
+		def locked(conn, cursor, statement, parameters, context, executemany):
+			if statement.startswith('UPDATE user SET last_seen'):
+				raise OperationalError(statement, parameters, Exception('database is locked'))
+		event.listen(db.engine, 'before_cursor_execute', locked)
+		try:
+			with self.assertLogs(self.app.logger, 'ERROR'):
+				self.assertEqual(self.client.get('/explore').status_code, 200)
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', locked)
+		# kept for the next flush
+		self.assertEqual(list(last_seen_buffer.pending), [u.id])
+		self.assertEqual(last_seen_buffer.flush(), 1)
+
+	def test_user_loader_cache(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.login('john')
+
+		load_by_id = lambda statements: [s for s in statements if 'WHERE user.id = ?' in s]
+		self.queries('/explore')
+		self.assertEqual(load_by_id(self.queries('/explore')), [])
+		self.assertGreater(user_cache.stats()['hits'], 0)
+
+		# editing the profile drops the snapshot, so the next request sees the new name
+		self.client.post('/edit_profile', data={'username': 'johnny', 'about_me': 'hi'})
+		self.assertNotIn(u.id, user_cache.entries)
+		self.assertIn('Hello, johnny!', self.client.get('/index').get_data(as_text=True))
+
+	def test_new_post_shows_in_the_post_count(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.login('john')
+		self.assertIn('0 posts', self.client.get('/user/john').get_data(as_text=True))
+		self.assertIn(u.id, user_cache.entries)
+		self.client.post('/', data={'body': 'my first post'})
+		self.assertIn('1 posts', self.client.get('/user/john').get_data(as_text=True))
+
+class LastSeenFlusherCase(unittest.TestCase):
+	def setUp(self):
+		# the flusher needs a connection of its own, which an in-memory database cannot give it
+		self.directory = tempfile.mkdtemp()
+		self.app = create_app(TestConfig)
+		self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'app.db'),
+			LAST_SEEN_FLUSHER=True, LAST_SEEN_FLUSH_INTERVAL=0.05)
+		last_seen_buffer.init_app(self.app)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+
+	def tearDown(self):
+		last_seen_buffer.stop()
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+		shutil.rmtree(self.directory)
+
+	def test_flushed_without_requests(self):
+		u = User(username='john', email='john@example.com', last_seen=datetime(2021, 1, 1))
+		db.session.add(u)
+		db.session.commit()
+		now = datetime.utcnow()
+		last_seen_buffer.record(u, now)
+		# no flush on the caller, the flusher writes it once the interval is up
+		self.assertEqual(list(last_seen_buffer.pending), [u.id])
+		for i in range(100):
+			if not last_seen_buffer.pending:
+				break
+			time.sleep(0.02)
+		db.session.expire_all()
+		self.assertEqual(User.query.get(u.id).last_seen, now)
+
+class LanguageWorkerConfig(TestConfig):
+	LANGUAGE_WORKERS = 1
+	LANGUAGE_CHUNK_SIZE = 1
+
+class LanguageWorkerCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(LanguageWorkerConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.client = self.app.test_client()
+
+	def tearDown(self):
+		language_worker.wait()
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def test_language_detected_in_background(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		leftovers = [u.add_post('Este mensaje quedó en la cola cuando el proceso anterior se detuvo', None),
+			u.add_post('Ce message est resté dans la file quand le processus précédent s’est arrêté', None)]
+		# one claimed by the sweep of another process that is still running, one by a sweep that died
+		claimed = u.add_post('Another process is detecting the language of this post right now', None)
+		claimed.language_claimed_until = datetime.utcnow() + timedelta(minutes=5)
+		leftovers[1].language_claimed_until = datetime.utcnow() - timedelta(seconds=1)
+		db.session.commit()
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+
+		# the request stores the post without a language and a worker thread detects it afterwards
+		threads = []
+		def run(text, run=language_detector.run):
+			threads.append(threading.current_thread())
+			return run(text)
+		with mock.patch.object(language_detector, 'run', side_effect=run):
+			self.client.post('/', data={'body': 'Nothing in this request waits for the language of this post'})
+			language_worker.wait()
+		post = Post.query.filter(Post.body.startswith('Nothing')).one()
+		self.assertEqual(post.language, 'en')
+		self.assertNotIn(threading.current_thread(), threads)
+
+		# the posts left over from before the restart were swept up in the background, one chunk at a time
+		for leftover in leftovers:
+			db.session.refresh(leftover)
+		self.assertEqual([leftover.language for leftover in leftovers], ['es', 'fr'])
+		db.session.refresh(claimed)
+		self.assertIsNone(claimed.language)
+
+class MailConfig(TestConfig):
+	MAIL_MAX_ATTEMPTS = 3
+	MAIL_RETRY_BACKOFF = 60
+
+class MailOutboxCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(MailConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+
+	def tearDown(self):
+		mail_dispatcher.stop()
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+
+	def queue(self, count):
+		for i in range(count):
+			send_email('Hello {}'.format(i), 'admin@example.com', ['user{}@example.com'.format(i)], 'text', '<p>html</p>')
+
+	def test_drain(self):
+		self.queue(3)
+		self.assertEqual(OutgoingMail.query.filter_by(status='pending').count(), 3)
+		# a message claimed by a worker that died is due again once its claim has run out
+		OutgoingMail.query.get(1).status = 'sending'
+		OutgoingMail.query.get(1).next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+		db.session.commit()
+		with mail.record_messages() as outbox:
+			self.assertEqual(mail_dispatcher.drain(), (3, 0, 0))
+		self.assertEqual(sorted(msg.recipients[0] for msg in outbox), ['user0@example.com', 'user1@example.com',
+			'user2@example.com'])
+		self.assertEqual(outbox[0].html, '<p>html</p>')
+		self.assertEqual(OutgoingMail.query.filter_by(status='sent').count(), 3)
+		self.assertEqual(mail_dispatcher.drain(), (0, 0, 0))
+
+	def test_retries_and_dead_letters(self):
+		self.queue(1)
+		with mock.patch('flask_mail.Connection.send', side_effect=smtplib.SMTPServerDisconnected('gone')):
+			self.assertEqual(mail_dispatcher.drain(), (0, 1, 0))
+			message = OutgoingMail.query.one()
+			self.assertEqual((message.status, message.attempts), ('pending', 1))
+			self.assertGreater(message.next_attempt_at, datetime.utcnow() + timedelta(seconds=50))
+			# backing off, so not due yet
+			self.assertEqual(mail_dispatcher.drain(), (0, 0, 0))
+			self.assertEqual(mail_dispatcher.drain(deferred=True), (0, 1, 0))
+			self.assertGreater(OutgoingMail.query.one().next_attempt_at, datetime.utcnow() + timedelta(seconds=110))
+			with self.assertLogs(self.app.logger, 'ERROR'):
+				self.assertEqual(mail_dispatcher.drain(deferred=True), (0, 0, 1))
+		message = OutgoingMail.query.one()
+		self.assertEqual((message.status, message.attempts), ('dead', 3))
+		self.assertIn('gone', message.last_error)
+		# dead letters stay where they are
+		with mail.record_messages() as outbox:
+			self.assertEqual(mail_dispatcher.drain(deferred=True), (0, 0, 0))
+		self.assertEqual(outbox, [])
+
+	def test_connections_are_reused(self):
+		self.app.extensions['mail'].suppress = False
+		self.app.extensions['mail'].max_emails = 2
+		self.queue(5)
+		with mock.patch('flask_mail.smtplib.SMTP') as smtp:
+			# the server dropped the first session before it was used
+			smtp.return_value.sendmail.side_effect = [smtplib.SMTPServerDisconnected('idle')] + [{}] * 5
+			self.assertEqual(mail_dispatcher.drain(), (5, 0, 0))
+		# one connection for the dropped session, one to replace it and one after every two messages
+		self.assertEqual(smtp.call_count, 4)
+
+		mail_dispatcher.reuse_connections = False
+		self.queue(3)
+		with mock.patch('flask_mail.smtplib.SMTP') as smtp:
+			self.assertEqual(mail_dispatcher.drain(), (3, 0, 0))
+		self.assertEqual(smtp.call_count, 3)
+
+	def test_unreachable_server_fails_the_batch(self):
+		self.app.extensions['mail'].suppress = False
+		self.queue(3)
+		with mock.patch('flask_mail.smtplib.SMTP', side_effect=ConnectionRefusedError()) as smtp:
+			self.assertEqual(mail_dispatcher.drain(), (0, 3, 0))
+		self.assertEqual(smtp.call_count, 1)
+		# only the message that was tried spent an attempt, the others were put back as they were
+		messages = OutgoingMail.query.order_by(OutgoingMail.id).all()
+		self.assertEqual([(message.status, message.attempts) for message in messages], [('pending', 1)] + [('pending', 0)] * 2)
+		self.assertTrue(all(message.next_attempt_at > datetime.utcnow() for message in messages))
+
+	def test_drain_command(self):
+		cli.register(self.app)
+		self.queue(2)
+		with mail.record_messages() as outbox:
+			result = self.app.test_cli_runner().invoke(args=['mail', 'drain'])
+		self.assertIn('Sent 2 messages, 0 failed and will be retried, 0 gave up.', result.output)
+		self.assertEqual(len(outbox), 2)
+
+class MailWorkerCase(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		class MailWorkerConfig(MailConfig):
+			MAIL_WORKERS = 2
+			# the workers need connections of their own, which an in-memory database cannot give them
+			SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory, 'mail.db')
+		self.app = create_app(MailWorkerConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+
+	def tearDown(self):
+		mail_dispatcher.stop()
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+		shutil.rmtree(self.directory)
+
+	def test_fixed_worker_pool(self):
+		threads = threading.active_count()
+		with mail.record_messages() as outbox:
+			for i in range(300):
+				send_email('Hello', 'admin@example.com', ['user{}@example.com'.format(i)], 'text', '<p>html</p>')
+			for i in range(200):
+				if OutgoingMail.query.filter_by(status='sent').count() == 300:
+					break
+				time.sleep(0.05)
+		self.assertEqual(len(outbox), 300)
+		self.assertEqual(threading.active_count(), threads + 2)
+
+class ErrorMailConfig(TestConfig):
+	MAIL_SERVER = 'mail.example.com'
+	ERROR_MAIL_WINDOW = 3600
+
+class ErrorMailCase(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app(ErrorMailConfig)
+		self.logger = logging.getLogger('error_mail_test')
+		self.logger.propagate = False
+		self.handler = error_mail_handler(self.app)
+		self.logger.addHandler(self.handler)
+
+	def tearDown(self):
+		self.logger.removeHandler(self.handler)
+
+	def log_error(self, exc_type):
+		try:
+			raise exc_type('boom')
+		except Exception:
+			self.logger.exception('Exception on /index')
+
+	def test_errors_are_grouped(self):
+		with mock.patch('app.error_mail.smtplib.SMTP') as smtp:
+			# a mail server that takes a second per message does not hold up the requests that log errors
+			smtp.return_value.send_message.side_effect = lambda msg: time.sleep(1)
+			start = time.monotonic()
+			for i in range(100):
+				self.log_error(ZeroDivisionError)
+			for i in range(20):
+				self.log_error(KeyError)
+			self.logger.error('Translator request failed')
+			self.assertLess(time.monotonic() - start, 0.5)
+			self.handler.close()
+		subjects = sorted(call.args[0]['Subject'] for call in smtp.return_value.send_message.call_args_list)
+		self.assertEqual(len(subjects), 3)
+		self.assertTrue(subjects[0].startswith('Microblog Failure: 1 x ERROR at '))
+		self.assertTrue(subjects[1].startswith('Microblog Failure: 100 x ZeroDivisionError at '))
+		self.assertTrue(subjects[2].startswith('Microblog Failure: 20 x KeyError at '))
+		self.assertIn('tests.py', subjects[1])
+		body = smtp.return_value.send_message.call_args_list[0].args[0].get_content()
+		self.assertIn('Traceback', body)
+
+class LogFileConfig(TestConfig):
+	LOG_FORMAT = 'json'
+	LOG_MAX_BYTES = 2000
+	LOG_BACKUP_COUNT = 3
+
+class LogFileCase(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.app = create_app(LogFileConfig)
+		self.app.config['LOG_FILE'] = os.path.join(self.directory, 'logs', 'microblog.log')
+		self.logger = logging.getLogger('log_file_test')
+		self.logger.propagate = False
+		self.logger.setLevel(logging.INFO)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def log(self, handler, lines):
+		self.logger.addHandler(handler)
+		for i in range(lines):
+			self.logger.info('Line %d of the log', i)
+		try:
+			{}['missing']
+		except KeyError:
+			self.logger.exception('Lookup failed')
+		self.logger.removeHandler(handler)
+		handler.close()
+
+	def test_json_lines_and_gzipped_backups(self):
+		self.log(file_log_handler(self.app), 100)
+		path = self.app.config['LOG_FILE']
+		with open(path) as f:
+			entries = [json.loads(line) for line in f]
+		self.assertEqual(entries[-1]['level'], 'ERROR')
+		self.assertEqual(entries[-1]['message'], 'Lookup failed')
+		self.assertIn("KeyError: 'missing'", entries[-1]['exception'])
+		self.assertTrue(entries[-1]['path'].endswith('tests.py'))
+		self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ['microblog.log', 'microblog.log.1.gz',
+			'microblog.log.2.gz', 'microblog.log.3.gz'])
+		with gzip.open(path + '.1.gz', 'rt') as f:
+			self.assertEqual(json.loads(f.readline())['logger'], 'log_file_test')
+
+	def test_text_lines_rotated_by_time(self):
+		self.app.config.update(LOG_FILE=os.path.join(self.directory, 'microblog.log'), LOG_FORMAT='text',
+			LOG_ROTATION='time')
+		handler = file_log_handler(self.app)
+		self.assertIsInstance(handler.listener.handlers[0], TimedRotatingFileHandler)
+		self.log(handler, 1)
+		with open(self.app.config['LOG_FILE']) as f:
+			lines = f.read().splitlines()
+		self.assertRegex(lines[0], r'INFO: Line 0 of the log \[in .*tests\.py:\d+\]$')
+		self.assertIn('Traceback (most recent call last):', lines)
+
+class TemplateCacheCase(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		class TemplateCacheConfig(TestConfig):
+			TEMPLATE_CACHE_DIR = os.path.join(self.directory, 'template_cache')
+		self.config = TemplateCacheConfig
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_precompiled_templates_are_not_compiled_again(self):
+		app = create_app(self.config)
+		cli.register(app)
+		result = app.test_cli_runner().invoke(args=['templates', 'precompile'])
+		self.assertEqual(result.exit_code, 0, result.output)
+		compiled = len(app.jinja_env.list_templates(filter_func=not_hidden))
+		self.assertIn('Compiled {} templates'.format(compiled), result.output)
+		self.assertEqual(len(os.listdir(self.config.TEMPLATE_CACHE_DIR)), compiled)
+
+		# a fresh worker renders its first pages without compiling anything
+		app = create_app(self.config)
+		with app.app_context():
+			db.create_all()
+			with mock.patch('jinja2.Environment.compile') as compile:
+				client = app.test_client()
+				self.assertEqual(client.get('/login').status_code, 200)
+				self.assertEqual(client.get('/register').status_code, 200)
+			self.assertFalse(compile.called)
+			db.session.remove()
+			db.drop_all()
+
+	def test_unusable_directory_runs_without_cache(self):
+		with tempfile.NamedTemporaryFile() as f:
+			class Config(self.config):
+				TEMPLATE_CACHE_DIR = os.path.join(f.name, 'template_cache') # under a file, so it cannot be created
+			with self.assertLogs('app', 'WARNING'):
+				app = create_app(Config)
+			self.assertIsNone(template_cache.bytecode_cache)
+			with app.app_context():
+				self.assertEqual(app.test_client().get('/login').status_code, 200)
+
+# short posts of the kind the classifiers are meant for
+SHORT_POSTS = [
+	'Just finished my morning run, feeling great today!',
+	'Does anyone know a good place to eat near the station?',
+	'The weather has been terrible all week long',
+	'I cannot believe how fast this year has gone by',
+	'Reading a wonderful book about the history of science',
+	'Our team finally won the match after a long season',
+	'Please remember to bring your umbrella tomorrow',
+	'My cat keeps sleeping on my keyboard while I work',
+	'Acabo de terminar mi carrera de la mañana, me siento genial',
+	'¿Alguien conoce un buen lugar para comer cerca de la estación?',
+	'El tiempo ha sido terrible durante toda la semana',
+	'No puedo creer lo rápido que ha pasado este año',
+	'Estoy leyendo un libro maravilloso sobre la historia de la ciencia',
+	'Nuestro equipo por fin ganó el partido después de una larga temporada',
+	'Por favor recuerda traer tu paraguas mañana',
+	'Mi gato sigue durmiendo sobre mi teclado mientras trabajo',
+	'Je viens de finir ma course du matin et je me sens très bien',
+	'Quelqu un connaît un bon endroit pour manger près de la gare?',
+	'Il a fait un temps horrible toute la semaine',
+	'Ich habe gerade meinen Morgenlauf beendet und fühle mich großartig',
+	'Das Wetter war die ganze Woche über schrecklich',
+	'Meine Katze schläft immer auf meiner Tastatur, während ich arbeite',
+]
+
+class NgramBackendCase(unittest.TestCase):
+	def test_agrees_with_langdetect(self):
+		backend = NgramBackend(['en', 'es', 'fr', 'de', 'it', 'pt'])
+		expected = LangdetectBackend().detect_many(SHORT_POSTS)
+		languages = backend.detect_many(SHORT_POSTS)
+		agreement = sum(a == b for a, b in zip(expected, languages)) / len(SHORT_POSTS)
+		self.assertGreaterEqual(agreement, 0.9)
+		self.assertEqual(backend.detect_many(['', '12345 !!!']), ['', ''])
+
+	def test_selected_by_config(self):
+		class NgramConfig(TestConfig):
+			LANGUAGE_DETECTOR = 'ngram'
+		create_app(NgramConfig)
+		self.assertIsInstance(language_detector.backend, NgramBackend)
+		self.assertEqual(language_detector.backend.languages, ['de', 'en', 'es', 'fr', 'it', 'pt'])
+		create_app(TestConfig)
+		self.assertIsInstance(language_detector.backend, LangdetectBackend)
+
+# a stand-in for the Microsoft translator on a local port; it answers every text with '<dest>: <text>' and keeps
+# the query string and texts of each request it gets. statuses queued in responses are answered first, body replaces
+# the translations in every answer, and every answer can be held back for delay seconds
+class FakeTranslator(object):
+	def __init__(self):
+		self.requests = []
+		self.status = 200
+		self.responses = []
+		self.delay = 0
+		self.body = None
+		fake = self
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1' # keep-alive
+			disable_nagle_algorithm = True
+
+			def do_POST(self):
+				texts = [item['Text'] for item in json.loads(self.rfile.read(int(self.headers['Content-Length'])))]
+				fake.requests.append((self.path, texts))
+				if fake.delay:
+					time.sleep(fake.delay)
+				dest = self.path.rsplit('to=', 1)[-1]
+				body = fake.body or json.dumps([{'translations': [{'text': dest + ': ' + text, 'to': dest}]} for text in texts])
+				try:
+					self.send_response(fake.responses.pop(0) if fake.responses else fake.status)
+					self.send_header('Content-Type', 'application/json')
+					self.send_header('Content-Length', str(len(body)))
+					self.end_headers()
+					self.wfile.write(body.encode())
+				except (BrokenPipeError, ConnectionResetError):
+					pass # the client timed out and went away
+
+			def log_message(self, *args):
+				pass
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+class TranslationCase(unittest.TestCase):
+	def setUp(self):
+		self.translator = FakeTranslator()
+		self.directory = tempfile.mkdtemp()
+		class TranslatorConfig(TestConfig):
+			# the threads of the concurrency tests need connections of their own
+			SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory, 'translate.db')
+			MS_TRANSLATOR_KEY = 'test'
+			MS_TRANSLATOR_URL = self.translator.url
+			MS_TRANSLATOR_READ_TIMEOUT = 0.5
+			MS_TRANSLATOR_BACKOFF = 0
+		self.app = create_app(TranslatorConfig)
+		self.app_context = self.app.app_context()
+		self.app_context.push()
+		db.create_all()
+		self.client = self.app.test_client()
+
+	def tearDown(self):
+		db.session.remove()
+		db.drop_all()
+		self.app_context.pop()
+		self.translator.stop()
+		shutil.rmtree(self.directory)
+
+	def test_repeated_translations_are_cached(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		data = {'text': 'Hola mundo', 'source_language': 'es', 'dest_language': 'en'}
+		for i in range(3):
+			self.assertEqual(self.client.post('/translate', data=data).get_json(), {'text': 'en: Hola mundo'})
+		self.assertEqual(len(self.translator.requests), 1)
+
+		# another process, or this one after a restart, finds it in the table
+		translation_cache.memory.clear()
+		self.assertEqual(translate('Hola mundo', 'es', 'en'), 'en: Hola mundo')
+		self.assertEqual(len(self.translator.requests), 1)
+		stats = self.client.get('/translate/stats').get_json()
+		self.assertEqual((stats['memory_hits'], stats['table_hits'], stats['misses']), (2, 1, 1))
+		self.assertEqual(stats['hit_rate'], 0.75)
+
+	def test_batch_translation(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		posts = [u.add_post('Hola {}'.format(i), 'es') for i in range(3)] + [u.add_post('Bonjour', 'fr')]
+		db.session.commit()
+		translate('Hola 0', 'es', 'en')
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		items = [{'post_id': p.id, 'source': p.language, 'dest': 'en'} for p in posts]
+		statements = []
+		def record(conn, cursor, statement, parameters, context, executemany):
+			if 'translation_cache' in statement:
+				statements.append(statement.split()[0])
+		event.listen(db.engine, 'before_cursor_execute', record)
+		try:
+			response = self.client.post('/translate/batch', json={'items': items}).get_json()
+		finally:
+			event.remove(db.engine, 'before_cursor_execute', record)
+		self.assertEqual(response['translations'], {str(p.id): 'en: ' + p.body for p in posts})
+		# one request per language pair, carrying only the texts that were not cached
+		self.assertEqual(sorted(texts for path, texts in self.translator.requests[1:]),
+			[['Bonjour'], ['Hola 1', 'Hola 2']])
+		# and per pair one lookup in the cache table and one transaction to store what was fetched
+		self.assertEqual(sorted(statements), ['DELETE'] * 2 + ['INSERT'] * 2 + ['SELECT'] * 2)
+		self.assertIn('Translate all on this page', self.client.get('/index').get_data(as_text=True))
+
+	def test_batch_translation_rejects_bad_input(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		item = {'post_id': 1, 'source': 'es', 'dest': 'en'}
+		for body in ([item], {'items': 'abc'}, {'items': [{'post_id': 1}]}, {'items': [dict(item, post_id='x')]},
+			{'items': [dict(item, source='')]}, {'items': [dict(item, source=None)]}, {'items': [7]},
+			{'items': [item] * (self.app.config['MS_TRANSLATOR_BATCH_MAX'] + 1)}):
+			self.assertEqual(self.client.post('/translate/batch', json=body).status_code, 400, body)
+		self.assertEqual(self.client.post('/translate/batch', data='not json').status_code, 400)
+		self.assertEqual(self.translator.requests, [])
+
+	def test_connections_are_reused(self):
+		for i in range(5):
+			self.assertEqual(translate('Hola {}'.format(i), 'es', 'en'), 'en: Hola {}'.format(i))
+		stats = translator_client.stats()
+		self.assertEqual((stats['calls'], stats['requests'], stats['connections']), (5, 5, 1))
+		self.assertEqual(stats['reuse_rate'], 0.8)
+
+	def test_retries_and_timeouts(self):
+		# two 503s are retried away
+		self.translator.responses = [503, 503]
+		self.assertEqual(translate('Hola', 'es', 'en'), 'en: Hola')
+		self.assertEqual(len(self.translator.requests), 3)
+		# a stalled translator gives up after the read timeout and its retries instead of hanging the request
+		self.translator.delay = 1
+		start = time.monotonic()
+		self.assertEqual(translate('Adiós', 'es', 'en'), 'Adiós es en')
+		self.assertLess(time.monotonic() - start, 3)
+		self.assertEqual(translator_client.stats()['errors'], 1)
+
+	# translates text from count threads that all start at once, returns what each of them got
+	def burst(self, text, count):
+		barrier = threading.Barrier(count)
+		results = []
+		def run():
+			with self.app.app_context():
+				barrier.wait()
+				results.append(translate(text, 'es', 'en'))
+		threads = [threading.Thread(target=run) for i in range(count)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return results
+
+	def test_identical_requests_are_coalesced(self):
+		self.translator.delay = 0.2
+		self.assertEqual(self.burst('Hola', 10), ['en: Hola'] * 10)
+		self.assertEqual(len(self.translator.requests), 1)
+		stats = single_flight.stats()
+		self.assertEqual((stats['leaders'], stats['followers'], stats['collapse_ratio']), (1, 9, 10))
+		self.assertEqual(single_flight.flights, {})
+
+	def test_coalescing_wait_is_bounded(self):
+		# followers stop waiting on a stalled leader and make their own calls
+		single_flight.timeout = 0.05
+		self.translator.delay = 0.3
+		self.assertEqual(self.burst('Hola', 3), ['en: Hola'] * 3)
+		self.assertEqual(len(self.translator.requests), 3)
+		self.assertEqual(single_flight.stats()['timeouts'], 2)
+
+	def test_deadline(self):
+		self.app.config['MS_TRANSLATOR_DEADLINE'] = 0.2
+		self.translator.delay = 0.4 # within the read timeout
+		start = time.monotonic()
+		self.assertEqual(translate('Hola', 'es', 'en'), 'Hola es en')
+		self.assertLess(time.monotonic() - start, 0.4)
+		# the call carried on in the background and its translation was cached
+		time.sleep(0.5)
+		self.assertEqual(translate('Hola', 'es', 'en'), 'en: Hola')
+		self.assertEqual(len(self.translator.requests), 1)
+
+	def test_batch_deadline_covers_every_pair(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		posts = [u.add_post('Text {}'.format(language), language) for language in ('es', 'fr', 'de', 'it', 'pt')]
+		db.session.commit()
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		self.app.config['MS_TRANSLATOR_DEADLINE'] = 0.2
+		self.translator.delay = 0.4 # within the read timeout
+		items = [{'post_id': p.id, 'source': p.language, 'dest': 'en'} for p in posts]
+		start = time.monotonic()
+		self.assertEqual(self.client.post('/translate/batch', json={'items': items}).status_code, 200)
+		self.assertLess(time.monotonic() - start, 0.4)
+		time.sleep(0.5) # lets the calls carried on in the background finish
+
+	def test_circuit_breaker(self):
+		breaker.min_calls = 3
+		breaker.cooldown = 0.2
+		self.translator.status = 500
+		with self.assertLogs(self.app.logger, 'WARNING') as logs:
+			for i in range(3):
+				self.assertEqual(translate('Hola {}'.format(i), 'es', 'en'), 'Hola {} es en'.format(i) if i < 2 else
+					'Error: the translation service is unavailable, please try again later.')
+		self.assertIn('Translator circuit breaker closed -> open', logs.output[-1])
+		requests = len(self.translator.requests)
+
+		# while open, requests fail fast without calling the translator
+		self.translator.status = 200
+		self.assertEqual(translate('Adiós', 'es', 'en'),
+			'Error: the translation service is unavailable, please try again later.')
+		self.assertEqual(len(self.translator.requests), requests)
+
+		# after the cooldown one trial call goes through and closes it again
+		time.sleep(0.25)
+		with self.assertLogs(self.app.logger, 'WARNING') as logs:
+			self.assertEqual(translate('Adiós', 'es', 'en'), 'en: Adiós')
+		self.assertEqual([line.split(':')[-1] for line in logs.output],
+			['Translator circuit breaker open -> half-open', 'Translator circuit breaker half-open -> closed'])
+		stats = breaker.stats()
+		self.assertEqual((stats['state'], stats['opened'], stats['half_opened'], stats['closed'], stats['rejected']),
+			('closed', 1, 1, 1, 1))
+
+	def test_unreadable_answers(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		breaker.min_calls = 1
+		breaker.cooldown = 0
+		data = {'text': 'Hola', 'source_language': 'es', 'dest_language': 'en'}
+		for body in ('<html>oops</html>', '{"error": 1}', '[{"translations": []}]', '[]'):
+			self.translator.body = body
+			with self.assertLogs(self.app.logger, 'WARNING'):
+				response = self.client.post('/translate', data=data)
+			self.assertEqual(response.status_code, 200)
+			self.assertEqual(breaker.stats()['state'], 'open')
+		# the trial calls of the half-open breaker were all accounted for, so it closes on the next good answer
+		self.translator.body = None
+		self.assertEqual(self.client.post('/translate', data=data).get_json(), {'text': 'en: Hola'})
+		self.assertEqual(breaker.stats()['state'], 'closed')
+
+	def test_client_errors_do_not_trip_the_breaker(self):
+		breaker.min_calls = 1
+		self.translator.status = 400
+		self.assertEqual(translate('Hola', 'es', 'xx'), 'Hola es xx')
+		self.assertEqual(breaker.stats()['state'], 'closed')
+
+	def test_slow_calls_trip_the_breaker(self):
+		breaker.min_calls = 2
+		breaker.slow_call = 0.1
+		self.translator.delay = 0.15
+		translate('Hola', 'es', 'en')
+		translate('Adiós', 'es', 'en')
+		self.assertEqual(breaker.stats()['state'], 'open')
+		self.assertEqual(translate('Gracias', 'es', 'en'),
+			'Error: the translation service is unavailable, please try again later.')
+		self.assertEqual(len(self.translator.requests), 2)
+
+	def test_async_view(self):
+		u = User(username='john', email='john@example.com')
+		u.set_password('cat')
+		db.session.add(u)
+		db.session.commit()
+		data = {'text': 'Hola', 'source_language': 'es', 'dest_language': 'en'}
+		self.assertEqual(self.client.post('/translate/async', data=data).status_code, 302)
+		self.client.post('/login', data={'username': 'john', 'password': 'cat'})
+		for i in range(2):
+			self.assertEqual(self.client.post('/translate/async', data=data).get_json(), {'text': 'en: Hola'})
+		self.assertEqual(len(self.translator.requests), 1)
+
+	def test_asgi_application(self):
+		u = User(username='john', email='john@example.com', last_seen=datetime(2021, 1, 1))
+		db.session.add(u)
+		db.session.commit()
+		cookie = self.app.session_interface.get_signing_serializer(self.app).dumps({'_user_id': str(u.id), '_fresh': True})
+		data = {'text': 'Hola', 'source_language': 'es', 'dest_language': 'en'}
+		self.translator.delay = 0.2
+		application = TranslationASGI(self.app)
+		async def run():
+			async with httpx.AsyncClient(app=application, base_url='http://localhost') as client:
+				# served on the loop, ten identical translations in flight at once share one upstream call
+				responses = await asyncio.gather(*[client.post('/translate', data=data, cookies={'session': cookie})
+					for i in range(10)])
+				# a body that is not UTF-8 is turned away too
+				garbled = await client.post('/translate', content=b'text=\xff', cookies={'session': cookie},
+					headers={'Content-Type': 'application/x-www-form-urlencoded'})
+				# the cookie of a user who is gone is turned away
+				gone = self.app.session_interface.get_signing_serializer(self.app).dumps({'_user_id': '999'})
+				deleted = await client.post('/translate', data=data, cookies={'session': gone})
+				# without a session the request goes to Flask, which redirects to the login page
+				anonymous = await client.post('/translate', data=data, allow_redirects=False)
+			await application.translator.aclose()
+			return responses, garbled, anonymous, deleted
+		responses, garbled, anonymous, deleted = asyncio.run(run())
+		self.assertEqual(garbled.status_code, 400)
+		self.assertEqual([r.json() for r in responses], [{'text': 'en: Hola'}] * 10)
+		self.assertEqual(len(self.translator.requests), 1)
+		self.assertEqual(anonymous.status_code, 302)
+		self.assertEqual(deleted.status_code, 401)
+		# the visits went through Flask-Login and were recorded like page views
+		self.assertEqual(list(last_seen_buffer.pending), [u.id])
+		self.assertEqual(last_seen_buffer.flush(), 1)
+
+	def test_failures_are_not_cached(self):
+		self.translator.status = 500
+		self.assertEqual(translate('Hola', 'es', 'en'), 'Hola es en')
+		self.translator.status = 200
+		self.assertEqual(translate('Hola', 'es', 'en'), 'en: Hola')
+		self.assertEqual(len(self.translator.requests), 4) # the failed translation was tried three times
+
+	def test_expired_translations(self):
+		self.assertEqual(translate('Hola', 'es', 'en'), 'en: Hola')
+		translation_cache.memory.clear()
+		db.session.execute(CachedTranslation.__table__.update().values(
+			created_at=datetime.utcnow() - timedelta(seconds=translation_cache.ttl + 1)))
+		db.session.commit()
+		self.assertIsNone(translation_cache.get('Hola', 'es', 'en'))
+		self.assertEqual(translation_cache.evict_expired(), 1)
+		self.assertEqual(translate('Hola', 'es', 'en'), 'en: Hola')
+		self.assertEqual(len(self.translator.requests), 2)
+
 if __name__ == '__main__':
 	unittest.main(verbosity=2)